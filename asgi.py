@@ -0,0 +1,419 @@
+"""Async deployment of the Contact API
+
+Serves the contact routes, the export and Swagger models of main.py from an ASGI server. Database access goes
+through psycopg's AsyncConnectionPool, so requests waiting on Postgres do not hold a thread:
+
+    uvicorn asgi:app --workers 2
+"""
+import contextlib
+import json
+import zlib
+
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+from flask_restx import inputs, marshal
+from starlette.applications import Starlette
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+
+from main import EXPORT_MIMETYPES, ContactDAO, api, app as flask_app, contact, contact_batch
+
+
+class AsyncContactDAO(ContactDAO):
+    """ContactDAO on an AsyncConnectionPool, the SQL and the contact cache are shared with the sync DAO"""
+
+    pool = None
+
+    @classmethod
+    async def open_pool(cls):
+        if AsyncContactDAO.pool is None:
+            AsyncContactDAO.pool = AsyncConnectionPool(cls.conninfo(),
+                                                       min_size=cls.POOL_MIN_SIZE,
+                                                       max_size=cls.POOL_MAX_SIZE,
+                                                       timeout=cls.POOL_TIMEOUT,
+                                                       check=AsyncConnectionPool.check_connection,
+                                                       name="contact-async",
+                                                       open=False)
+            await AsyncContactDAO.pool.open()
+        return AsyncContactDAO.pool
+
+    @classmethod
+    async def close_pool(cls):
+        if AsyncContactDAO.pool is not None:
+            await AsyncContactDAO.pool.close()
+            AsyncContactDAO.pool = None
+
+    def connection(self):
+        return AsyncContactDAO.pool.connection()
+
+    async def get_all(self, field=None, direction=None, limit=None, after=None, filters=None):
+        sql, params, field = self.list_query(field, direction, limit, after, filters)
+        async with self.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(sql, params)
+                listing = list(self.iter_contacts(await cur.fetchall()))
+        return listing, self.next_cursor(listing, field, limit, after, filters)
+
+    def iter_all(self, field=None, direction=None, limit=None, after=None, filters=None):
+        sql, params, field = self.list_query(field, direction, limit, after, filters)
+        return self.iter_query(sql, params)
+
+    async def iter_query(self, sql, params):
+        async with self.connection() as conn:
+            async with conn.cursor(name="contact_stream", row_factory=dict_row) as cur:
+                await cur.execute(sql, params)
+                # a contact's rows can straddle two fetches, hold the last contact back until the next one starts
+                pending = None
+                while True:
+                    rows = await cur.fetchmany(self.STREAM_ITERSIZE)
+                    if len(rows) == 0:
+                        break
+                    for c1 in self.iter_contacts(rows):
+                        if pending is not None and pending.get("contact_id") == c1.get("contact_id"):
+                            pending["addresses"] += c1["addresses"]
+                            continue
+                        if pending is not None:
+                            yield pending
+                        pending = c1
+                if pending is not None:
+                    yield pending
+
+    async def get_all_documents(self, field=None, direction=None, limit=None, after=None, filters=None):
+        sql, params, field = self.list_query(field, direction, limit, after, filters, documents=True)
+        async with self.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(sql, params)
+                rows = await cur.fetchall()
+        last = rows[-1] if len(rows) > 0 else (None, None)
+        return [row[2] for row in rows], self.page_cursor(len(rows), last[0], last[1], limit, after, filters)
+
+    def iter_documents(self, field=None, direction=None, limit=None, after=None, filters=None):
+        sql, params, field = self.list_query(field, direction, limit, after, filters, documents=True)
+        return self.iter_document_query(sql, params)
+
+    async def iter_document_query(self, sql, params):
+        async with self.connection() as conn:
+            async with conn.cursor(name="contact_document_stream") as cur:
+                await cur.execute(sql, params)
+                while True:
+                    rows = await cur.fetchmany(self.STREAM_ITERSIZE)
+                    if len(rows) == 0:
+                        break
+                    for row in rows:
+                        yield row[2]
+
+    async def get_document(self, contact_id):
+        key = self.contact_key(contact_id)
+        async with self.connection() as conn:
+            cur = await conn.execute(self.select_document_sql(), (key,))
+            row = await cur.fetchone()
+        return self.document_entry(contact_id, row)
+
+    async def copy_out(self, sql, params):
+        async with self.connection() as conn:
+            async with conn.cursor() as cur:
+                async with cur.copy(sql, params) as copy:
+                    buffer = bytearray()
+                    async for data in copy:
+                        buffer += data
+                        if len(buffer) >= self.EXPORT_CHUNK_SIZE:
+                            yield bytes(buffer)
+                            buffer.clear()
+                    if len(buffer) > 0:
+                        yield bytes(buffer)
+
+    async def get_versioned(self, contact_id):
+        key = self.contact_key(contact_id)
+        entry = self.cached(key)
+        if entry is not None:
+            return entry
+
+        generation = self.generation(key)
+        async with self.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(self.select_contacts_sql(self.contact_table_name + ".contact_id in (%s)"), (key,))
+                contacts = await cur.fetchall()
+        return self.store(key, contacts, generation)
+
+    async def get_many(self, contact_ids):
+        keys, missing = self.batch_keys(contact_ids)
+        found = self.cached_many(keys)
+        wanted = [key for key in keys if key not in found]
+        if len(wanted) > 0:
+            generations = {key: self.generation(key) for key in wanted}
+            async with self.connection() as conn:
+                async with conn.cursor(row_factory=dict_row) as cur:
+                    await cur.execute(self.select_contacts_sql(self.contact_table_name + ".contact_id = ANY(%s)"), (wanted,))
+                    found.update(self.store_many(await cur.fetchall(), generations))
+        return self.batch_result(keys, missing, found)
+
+    async def create(self, data):
+        async with self.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(self.insert_contact_sql(), self.contact_values(data))
+                new_contact = await cur.fetchone()
+                addresses = data.get("addresses", None)
+                if isinstance(addresses, list) and len(addresses) > 0:
+                    new_addresses = []
+                    for add in addresses:
+                        await cur.execute(self.insert_address_sql(), self.address_values(new_contact.get("contact_id"), add))
+                        new_addresses.append(await cur.fetchone())
+                    new_contact["addresses"] = new_addresses
+                await conn.commit()
+        self.invalidate(new_contact.get("contact_id"))
+        return new_contact
+
+    async def update(self, contact_id, data, partial=False):
+        key = self.contact_key(contact_id)
+        sql, params = self.update_query(key, data, partial)
+        async with self.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cur:
+                await cur.execute(sql, params)
+                rows = await cur.fetchall()
+                await conn.commit()
+        if len(rows) == 0:
+            api.abort(404, "Contact {} doesn't exist".format(contact_id))
+        self.invalidate(key)
+        return self.parse_db_contact(rows)
+
+    async def delete(self, contact_id):
+        key = self.cache_key(contact_id)
+        if key is None:
+            return
+        async with self.connection() as conn:
+            await conn.execute("DELETE FROM " + self.contact_table_name + " WHERE contact_id=%s", (key,))
+        self.invalidate(key)
+
+
+contact_dao = AsyncContactDAO()
+MASK_HEADER = flask_app.config["RESTX_MASK_HEADER"]
+
+
+def json_response(data, status_code=200, headers=None):
+    # same body as flask-restx's JSON representation
+    return Response(json.dumps(data) + "\n", status_code, headers, media_type="application/json")
+
+
+def query_arg(request, name, type=str, choices=None, help=None):
+    value = request.query_params.get(name)
+    if value is None:
+        return None
+    try:
+        value = type(value)
+        if choices is not None and value not in choices:
+            raise ValueError("The value '{}' is not a valid choice for '{}'.".format(value, name))
+    except ValueError as e:
+        api.abort(400, "Input payload validation failed", errors={name: "{} {}".format(help, e)})
+    return value
+
+
+async def payload(request):
+    body = await request.body()
+    if len(body) == 0:
+        return {}
+    try:
+        return json.loads(body)
+    except ValueError:
+        api.abort(400, "Failed to decode JSON object")
+
+
+async def list_contacts(request, filters=None):
+    field = query_arg(request, "field", help="Order By Field")
+    direction = query_arg(request, "direction", help="Order By Direction")
+    limit = query_arg(request, "limit", int, help="Page size")
+    after = query_arg(request, "after", help="Cursor returned in X-Next-Cursor by the previous page")
+    stream = query_arg(request, "stream", choices=("json", "ndjson"), help="Stream the listing as a JSON array or NDJSON")
+    # a field mask needs marshal, documents always hold every field
+    mask = request.headers.get(MASK_HEADER)
+    documents = contact_dao.DOCUMENTS != "off" and mask is None
+    if stream is not None:
+        media_type = "application/x-ndjson" if stream == "ndjson" else "application/json"
+        if documents:
+            items = await peek_stream(contact_dao.iter_documents(field, direction, limit, after, filters), after, filters)
+            return StreamingResponse(stream_documents(items, stream), media_type=media_type)
+        contacts = await peek_stream(contact_dao.iter_all(field, direction, limit, after, filters), after, filters)
+        return StreamingResponse(stream_contacts(contacts, stream, mask), media_type=media_type)
+
+    if documents:
+        listing, next_cursor = await contact_dao.get_all_documents(field, direction, limit, after, filters)
+        headers = {} if next_cursor is None else {"X-Next-Cursor": next_cursor}
+        return Response("[" + ", ".join(listing) + "]\n", 200, headers, media_type="application/json")
+    listing, next_cursor = await contact_dao.get_all(field, direction, limit, after, filters)
+    headers = {} if next_cursor is None else {"X-Next-Cursor": next_cursor}
+    return json_response(marshal(listing, contact, mask=mask), 200, headers)
+
+
+async def search_contacts(request):
+    filters = contact_dao.search_filters(query_arg(request, "name"), query_arg(request, "email"),
+                                         query_arg(request, "city"), query_arg(request, "province"),
+                                         query_arg(request, "postal_code"))
+    if len(filters) == 0:
+        api.abort(400, "Give at least one of name, email, city, province or postal_code")
+    return await list_contacts(request, filters)
+
+
+async def peek_stream(items, after, filters=None):
+    # read the first item before answering, so an empty stream fails the same way as an empty page
+    async for first in items:
+        return resume_stream(first, items)
+    contact_dao.check_listing(0, after, filters)
+    return items
+
+
+async def resume_stream(first, items):
+    yield first
+    async for item in items:
+        yield item
+
+
+async def stream_contacts(contacts, fmt, mask=None):
+    if fmt == "ndjson":
+        async for c in contacts:
+            yield json.dumps(marshal(c, contact, mask=mask)) + "\n"
+        return
+    yield "["
+    separator = ""
+    async for c in contacts:
+        yield separator + json.dumps(marshal(c, contact, mask=mask))
+        separator = ","
+    yield "]"
+
+
+async def stream_documents(documents, fmt):
+    if fmt == "ndjson":
+        async for document in documents:
+            yield document + "\n"
+        return
+    yield "["
+    separator = ""
+    async for document in documents:
+        yield separator + document
+        separator = ", "
+    yield "]"
+
+
+async def create_contact(request):
+    return json_response(marshal(await contact_dao.create(await payload(request)), contact), 201)
+
+
+async def get_contacts(request):
+    ids = query_arg(request, "ids", help="Comma separated contact identifiers")
+    if ids is None:
+        api.abort(400, "Input payload validation failed", errors={"ids": "Comma separated contact identifiers Missing required parameter in the query string"})
+    found, missing = await contact_dao.get_many(ids.split(","))
+    return json_response(marshal({"contacts": found, "missing": missing}, contact_batch))
+
+
+async def get_contact(request):
+    mask = request.headers.get(MASK_HEADER)
+    documents = contact_dao.DOCUMENTS != "off" and mask is None
+    if documents:
+        etag, found = await contact_dao.get_document(request.path_params["contact_id"])
+    else:
+        etag, found = await contact_dao.get_versioned(request.path_params["contact_id"])
+    etag = contact_dao.masked_etag(etag, mask)
+    headers = {"ETag": quote_etag(etag), "Vary": MASK_HEADER}
+    if parse_etags(request.headers.get("If-None-Match")).contains_weak(etag):
+        return Response(status_code=304, headers=headers)
+    if documents:
+        return Response(found + "\n", 200, headers, media_type="application/json")
+    return json_response(marshal(found, contact, mask=mask), 200, headers)
+
+
+async def update_contact(request):
+    partial = request.method == "PATCH"
+    updated = await contact_dao.update(request.path_params["contact_id"], await payload(request), partial=partial)
+    return json_response(marshal(updated, contact))
+
+
+async def delete_contact(request):
+    await contact_dao.delete(request.path_params["contact_id"])
+    return Response(status_code=204)
+
+
+async def export_contacts(request):
+    fmt = query_arg(request, "format", choices=tuple(EXPORT_MIMETYPES),
+                    help="NDJSON with nested addresses, or CSV with one line per address") or "ndjson"
+    updated_since = query_arg(request, "updated_since", inputs.datetime_from_iso8601,
+                              help="Only contacts changed at or after this ISO 8601 time")
+    chunks = contact_dao.export(fmt, updated_since)
+    headers = {"Vary": "Accept-Encoding"}
+    if parse_accept_header(request.headers.get("Accept-Encoding"))["gzip"]:
+        chunks = gzip_stream(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return StreamingResponse(chunks, 200, headers, media_type=EXPORT_MIMETYPES[fmt])
+
+
+async def gzip_stream(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        data = compressor.compress(chunk)
+        if len(data) > 0:
+            yield data
+    yield compressor.flush()
+
+
+async def pool_stats(request):
+    return json_response(AsyncContactDAO.pool_stats())
+
+
+async def cache_stats(request):
+    return json_response(AsyncContactDAO.cache_stats())
+
+
+async def swagger(request):
+    return json_response(SWAGGER)
+
+
+async def http_error(request, exc):
+    return json_response(getattr(exc, "data", None) or {"message": exc.description}, exc.code)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await AsyncContactDAO.open_pool()
+    yield
+    await AsyncContactDAO.close_pool()
+
+
+def served_specification(specification, routes):
+    """The specification limited to the paths and methods of the routes"""
+    served = {}
+    for route in routes:
+        served.setdefault(route.path, set()).update(method.lower() for method in route.methods)
+    paths = {}
+    for path, operations in specification["paths"].items():
+        kept = {name: value for name, value in operations.items() if name in served.get(path, ())}
+        if len(kept) > 0:
+            if "parameters" in operations:
+                kept["parameters"] = operations["parameters"]
+            paths[path] = kept
+    return dict(specification, paths=paths)
+
+
+ROUTES = [
+    Route("/contacts/", list_contacts, methods=["GET"]),
+    Route("/contacts/", create_contact, methods=["POST"]),
+    Route("/contacts/batch", get_contacts, methods=["GET"]),
+    Route("/contacts/export", export_contacts, methods=["GET"]),
+    Route("/contacts/search", search_contacts, methods=["GET"]),
+    Route("/contacts/{contact_id}", get_contact, methods=["GET"]),
+    Route("/contacts/{contact_id}", update_contact, methods=["PUT", "PATCH"]),
+    Route("/contacts/{contact_id}", delete_contact, methods=["DELETE"]),
+    Route("/stats/pool", pool_stats, methods=["GET"]),
+    Route("/stats/cache", cache_stats, methods=["GET"]),
+    Route("/swagger.json", swagger, methods=["GET"]),
+]
+
+# the sync app documents the same routes and models, publish the part of its specification served here
+with flask_app.test_request_context():
+    SWAGGER = served_specification(api.__schema__, ROUTES)
+
+app = Starlette(
+    routes=ROUTES,
+    exception_handlers={HTTPException: http_error},
+    lifespan=lifespan,
+)
@@ -0,0 +1,114 @@
+"""Helpers shared by the benchmark scripts"""
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import psycopg
+from psycopg_pool import ConnectionPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from main import ContactDAO  # noqa: E402
+
+
+class CountingCursor(psycopg.Cursor):
+    """Cursor counting the statements it sends, each one is a round trip"""
+
+    statements = 0
+
+    def execute(self, *args, **kwargs):
+        CountingCursor.statements += 1
+        return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        CountingCursor.statements += 1
+        return super().executemany(*args, **kwargs)
+
+    def copy(self, *args, **kwargs):
+        CountingCursor.statements += 1
+        return super().copy(*args, **kwargs)
+
+
+class CountingServerCursor(psycopg.ServerCursor):
+    """Named cursor counting its DECLARE and every batch of itersize rows it fetches"""
+
+    def execute(self, *args, **kwargs):
+        CountingCursor.statements += 1
+        return super().execute(*args, **kwargs)
+
+    def _fetch_gen(self, num):
+        # every FETCH, whether from iteration or fetchmany(), goes through here
+        CountingCursor.statements += 1
+        return super()._fetch_gen(num)
+
+
+def counting_pool(min_size=1, max_size=1):
+    """A ContactDAO pool whose connections count the statements they send in CountingCursor.statements"""
+
+    def configure(conn):
+        conn.server_cursor_factory = CountingServerCursor
+
+    return ConnectionPool(ContactDAO.conninfo(), min_size=min_size, max_size=max_size,
+                          kwargs={"cursor_factory": CountingCursor}, configure=configure, open=True)
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of an unsorted list"""
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100.0 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024.0 * 1024.0) if sys.platform == "darwin" else peak / 1024.0
+
+
+class ThrowawayPostgres(object):
+    """A temporary Postgres cluster on a unix socket, removed on exit
+
+    The server binaries (initdb, pg_ctl) are looked up in PG_BIN, then on the PATH.
+    """
+
+    def __init__(self):
+        self.directory = None
+
+    def binary(self, name):
+        path = shutil.which(name, path=os.environ.get("PG_BIN")) or shutil.which(name)
+        if path is None:
+            sys.exit("{} not found, put the Postgres binaries on the PATH or in PG_BIN".format(name))
+        return path
+
+    def __enter__(self):
+        self.directory = tempfile.mkdtemp(prefix="contact-bench-")
+        try:
+            self.start()
+        except BaseException:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            raise
+        ContactDAO.DB_HOST = self.directory
+        return self
+
+    def start(self):
+        data = os.path.join(self.directory, "data")
+        subprocess.run([self.binary("initdb"), "-D", data, "-U", ContactDAO.DB_USER, "--auth=trust", "-E", "UTF8"],
+                       check=True, stdout=subprocess.DEVNULL)
+        # durability does not matter for a throwaway cluster
+        options = "-k {} -c listen_addresses='' -c fsync=off -c synchronous_commit=off -c full_page_writes=off".format(
+            self.directory)
+        subprocess.run([self.binary("pg_ctl"), "-D", data, "-o", options, "-l", os.path.join(self.directory, "log"),
+                        "-w", "start"], check=True, stdout=subprocess.DEVNULL)
+        with psycopg.connect(host=self.directory, user=ContactDAO.DB_USER, dbname="postgres", autocommit=True) as conn:
+            conn.execute("CREATE DATABASE " + ContactDAO.DB_USER)
+
+    def __exit__(self, *exc):
+        subprocess.run([self.binary("pg_ctl"), "-D", os.path.join(self.directory, "data"), "-m", "immediate", "stop"],
+                       stdout=subprocess.DEVNULL)
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,55 @@
+"""Compare two load_test.py reports and fail when a metric regressed past a threshold
+
+    python benchmarks/compare.py baseline.json current.json --threshold 15
+"""
+import argparse
+import json
+import sys
+
+# metrics where a bigger number is worse
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "p99_ms", "round_trips_per_request", "peak_rss_mb")
+HIGHER_IS_BETTER = ("throughput_rps",)
+
+
+def compare(baseline, current, threshold):
+    regressions = []
+    rows = []
+    for scenario, runs in sorted(current["results"].items()):
+        for mode, metrics in sorted(runs.items()):
+            if not isinstance(metrics, dict):
+                continue
+            before = baseline["results"].get(scenario, {}).get(mode, {})
+            for metric in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+                old, new = before.get(metric), metrics.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old * 100.0
+                worse = change > threshold if metric in LOWER_IS_BETTER else change < -threshold
+                rows.append((scenario, mode, metric, old, new, change, worse))
+                if worse:
+                    regressions.append((scenario, mode, metric))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=10.0, help="allowed change in percent")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    rows, regressions = compare(baseline, current, args.threshold)
+    for scenario, mode, metric, old, new, change, worse in rows:
+        print("%-12s %-12s %-24s %12.2f %12.2f %+8.1f%%%s" % (scenario, mode, metric, old, new, change,
+                                                              "  REGRESSION" if worse else ""))
+    if regressions:
+        sys.exit("%d metrics regressed by more than %.0f%%" % (len(regressions), args.threshold))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""Load test of the Contact API against a seeded Postgres
+
+Seeds a throwaway Postgres cluster (initdb and pg_ctl from PG_BIN or the PATH), then for every scenario drives the
+Flask app through its test client and through a concurrent HTTP load generator. Latency percentiles, throughput,
+database round trips per request and peak RSS are written as JSON for compare.py:
+
+    python benchmarks/load_test.py --contacts 100000 --max-addresses 5 --output bench.json
+
+--existing runs against the database configured through the CONTACT_DB_* environment variables instead,
+--seed-data then drops and reseeds its tables.
+"""
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from queue import Empty
+
+from werkzeug.serving import make_server
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import ContactDAO, CountingCursor, ThrowawayPostgres, counting_pool, peak_rss_mb, percentile  # noqa: E402
+
+import main as contact_api  # noqa: E402
+
+FIRST_NAMES = ["Ada", "Alan", "Barbara", "Claude", "Donald", "Edsger", "Frances", "Grace", "John", "Ken",
+               "Leslie", "Margaret", "Niklaus", "Radia", "Tim", "Whitfield"]
+LAST_NAMES = ["Lovelace", "Turing", "Liskov", "Shannon", "Knuth", "Dijkstra", "Allen", "Hopper", "Backus", "Thompson",
+              "Lamport", "Hamilton", "Wirth", "Perlman", "Berners-Lee", "Diffie"]
+CITIES = ["Toronto", "Montreal", "Vancouver", "Calgary", "Ottawa", "Halifax", "Winnipeg", "Regina"]
+
+
+def seed(contacts, max_addresses):
+    """Rebuild the schema and fill it with generated contacts, each with 0 to max_addresses addresses"""
+    dao = ContactDAO()
+    dao.migrate(drop=True)
+    with dao.connection() as conn:
+        conn.execute("INSERT INTO " + dao.contact_table_name + " (birth_date, first_name, last_name, middle_name) " +
+                     "SELECT date '1950-01-01' + mod(g, 20000), (%s::text[])[1 + mod(g, %s)], " +
+                     "(%s::text[])[1 + mod(g / %s, %s)] || g, NULL FROM generate_series(1, %s) g",
+                     (FIRST_NAMES, len(FIRST_NAMES), LAST_NAMES, len(FIRST_NAMES), len(LAST_NAMES), contacts))
+        if max_addresses > 0:
+            # a deterministic spread of 0..max_addresses addresses per contact
+            conn.execute("INSERT INTO " + dao.address_table_name +
+                         " (contact_id, country, title, postal_code, phone, province, city, street1, email) " +
+                         "SELECT c.contact_id, 'CAN', 'Dr', 'K1A ' || n || 'B' || n, '555-01' || n, 'ON', " +
+                         "(%s::text[])[1 + mod(c.contact_id + n, %s)], n || ' Main Street', " +
+                         "'contact' || c.contact_id || '.' || n || '@example.com' " +
+                         "FROM " + dao.contact_table_name + " c, generate_series(1, %s) n " +
+                         "WHERE n <= mod(c.contact_id::bigint * 2654435761, %s)",
+                         (CITIES, len(CITIES), max_addresses, max_addresses + 1))
+        conn.commit()
+        conn.autocommit = True
+        conn.execute("VACUUM ANALYZE")
+        conn.autocommit = False
+
+
+def contact_ids():
+    with ContactDAO().connection() as conn:
+        low, high = conn.execute("SELECT MIN(contact_id), MAX(contact_id) FROM " + ContactDAO.contact_table_name).fetchone()
+    if low is None:
+        sys.exit("the contact table is empty, seed it first")
+    return low, high
+
+
+def new_contact(rng):
+    return {"first_name": rng.choice(FIRST_NAMES), "last_name": rng.choice(LAST_NAMES),
+            "addresses": [{"city": rng.choice(CITIES), "country": "CAN", "email": "bench@example.com"},
+                          {"city": rng.choice(CITIES), "country": "CAN"}]}
+
+
+class Scenario(object):
+    """One endpoint under test, request() returns (method, path, json body)"""
+
+    def __init__(self, name, request, setup=None):
+        self.name = name
+        self.request = request
+        self.setup = setup
+
+
+def scenarios(low, high, full_listing):
+    def created_ids(count):
+        # contacts that the delete scenario can remove
+        with ContactDAO().connection() as conn:
+            rows = conn.execute("INSERT INTO " + ContactDAO.contact_table_name + " (first_name, last_name) " +
+                                "SELECT 'Delete', 'Me' || g FROM generate_series(1, %s) g RETURNING contact_id",
+                                (count,)).fetchall()
+        return [row[0] for row in rows]
+
+    listed = [
+        Scenario("list_page", lambda rng, state: ("GET", "/contacts/?limit=100&field=last_name", None)),
+        Scenario("list_stream", lambda rng, state: ("GET", "/contacts/?stream=ndjson&limit=1000", None)),
+        Scenario("get", lambda rng, state: ("GET", "/contacts/%d" % rng.randint(low, high), None)),
+        Scenario("batch", lambda rng, state: (
+            "GET", "/contacts/batch?ids=" + ",".join(str(rng.randint(low, high)) for _ in range(50)), None)),
+        Scenario("search", lambda rng, state: (
+            "GET", "/contacts/search?limit=50&name=" + rng.choice(LAST_NAMES)[:3], None)),
+        Scenario("create", lambda rng, state: ("POST", "/contacts/", new_contact(rng))),
+        Scenario("update", lambda rng, state: ("PUT", "/contacts/%d" % rng.randint(low, high), new_contact(rng))),
+        Scenario("delete", lambda rng, state: ("DELETE", "/contacts/%d" % state.pop(), None), created_ids),
+    ]
+    if full_listing:
+        listed.insert(0, Scenario("list_all", lambda rng, state: ("GET", "/contacts/", None)))
+    return listed
+
+
+def summarize(latencies, elapsed, errors):
+    ms = [latency * 1000 for latency in latencies]
+    return {"requests": len(ms), "errors": errors,
+            "p50_ms": percentile(ms, 50), "p95_ms": percentile(ms, 95), "p99_ms": percentile(ms, 99),
+            "mean_ms": sum(ms) / len(ms) if len(ms) > 0 else None,
+            "throughput_rps": len(ms) / elapsed if elapsed > 0 else None}
+
+
+def run_test_client(scenario, requests, state, seed_value):
+    client = contact_api.app.test_client()
+    rng = random.Random(seed_value)
+    latencies = []
+    errors = 0
+    statements = 0
+    started = time.perf_counter()
+    for _ in range(requests):
+        method, path, body = scenario.request(rng, state)
+        CountingCursor.statements = 0
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        latencies.append(time.perf_counter() - start)
+        statements += CountingCursor.statements
+        if response.status_code >= 400:
+            errors += 1
+    result = summarize(latencies, time.perf_counter() - started, errors)
+    result["round_trips_per_request"] = statements / float(requests) if requests > 0 else None
+    return result
+
+
+def run_http(scenario, requests, concurrency, state, seed_value):
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, contact_api.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    port = server.server_port
+    remaining = [requests]
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+
+    def worker(index):
+        rng = random.Random(seed_value + index)
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        while True:
+            with lock:
+                if remaining[0] == 0:
+                    break
+                remaining[0] -= 1
+            method, path, body = scenario.request(rng, state)
+            payload = None if body is None else json.dumps(body)
+            headers = {} if body is None else {"Content-Type": "application/json"}
+            start = time.perf_counter()
+            conn.request(method, path, payload, headers)
+            response = conn.getresponse()
+            response.read()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if response.status >= 400:
+                    errors[0] += 1
+        conn.close()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    result = summarize(latencies, time.perf_counter() - started, errors[0])
+    result["concurrency"] = concurrency
+    server.shutdown()
+    return result
+
+
+def run_scenario(scenario, args, queue):
+    """Runs in a forked child so the peak RSS belongs to this scenario alone"""
+    ContactDAO.pool = counting_pool(max_size=max(args.concurrency, 2))
+    if args.no_cache:
+        ContactDAO.CACHE_SIZE = 0
+    ContactDAO.DOCUMENTS = args.documents
+    ContactDAO.cache = None
+    baseline = peak_rss_mb()
+    state = scenario.setup(args.requests + args.http_requests + args.warmup) if scenario.setup else None
+
+    run_test_client(scenario, args.warmup, state, args.seed)
+    result = {"test_client": run_test_client(scenario, args.requests, state, args.seed)}
+    result["test_client"]["peak_rss_mb"] = peak_rss_mb()
+    if args.http_requests > 0:
+        result["http"] = run_http(scenario, args.http_requests, args.concurrency, state, args.seed)
+        result["http"]["peak_rss_mb"] = peak_rss_mb()
+    result["baseline_rss_mb"] = baseline
+    ContactDAO.close_pool()
+    queue.put(result)
+
+
+def wait_for_result(process, queue, name):
+    """The scenario result, or exit when the child died without sending one"""
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive():
+                sys.exit("scenario %s failed with exit code %s" % (name, process.exitcode))
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args):
+    # the materialized documents are installed by the migrations of the seed
+    ContactDAO.DOCUMENTS = args.documents
+    if args.seed_data:
+        print("seeding %d contacts with up to %d addresses" % (args.contacts, args.max_addresses), file=sys.stderr)
+        seed(args.contacts, args.max_addresses)
+    low, high = contact_ids()
+    # the parent must not hold pool connections across the fork
+    ContactDAO.close_pool()
+
+    results = {}
+    context = multiprocessing.get_context("fork")
+    for scenario in scenarios(low, high, args.full_listing):
+        if args.scenarios and scenario.name not in args.scenarios:
+            continue
+        print("running %s" % scenario.name, file=sys.stderr)
+        queue = context.Queue()
+        process = context.Process(target=run_scenario, args=(scenario, args, queue))
+        process.start()
+        results[scenario.name] = wait_for_result(process, queue, scenario.name)
+        process.join()
+
+    return {"meta": {"contacts": high - low + 1, "max_addresses": args.max_addresses, "requests": args.requests,
+                     "http_requests": args.http_requests, "concurrency": args.concurrency, "cache": not args.no_cache,
+                     "documents": args.documents,
+                     "revision": git_revision(), "python": platform.python_version(),
+                     "date": datetime.now(timezone.utc).isoformat()},
+            "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--contacts", type=int, default=10000, help="contacts to seed")
+    parser.add_argument("--max-addresses", type=int, default=3, help="addresses per contact range from 0 to this")
+    parser.add_argument("--requests", type=int, default=200, help="test client requests per scenario")
+    parser.add_argument("--http-requests", type=int, default=1000, help="HTTP requests per scenario, 0 skips them")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent HTTP clients")
+    parser.add_argument("--warmup", type=int, default=20, help="unmeasured requests before each scenario")
+    parser.add_argument("--scenarios", nargs="+", help="only run these scenarios")
+    parser.add_argument("--full-listing", action="store_true", help="also time the unpaged GET /contacts/")
+    parser.add_argument("--no-cache", action="store_true", help="turn the contact cache off")
+    parser.add_argument("--documents", choices=("off", "aggregate", "materialized"), default=ContactDAO.DOCUMENTS,
+                        help="where contact JSON is built, see CONTACT_DOCUMENTS")
+    parser.add_argument("--seed", type=int, default=42, help="random seed of the request generator")
+    parser.add_argument("--existing", action="store_true", help="use the CONTACT_DB_* database")
+    parser.add_argument("--seed-data", action="store_true",
+                        help="with --existing, drop and reseed the tables (always done on a throwaway cluster)")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    if args.existing:
+        report = benchmark(args)
+    else:
+        args.seed_data = True
+        with ThrowawayPostgres():
+            report = benchmark(args)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Listing serialization: marshal over dict rows against the compiled serializer over tuple rows
+
+Works on synthetic rows shaped like the listing query, no database needed:
+
+    python benchmarks/serialization.py --contacts 20000 --addresses 3
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from flask_restx import marshal  # noqa: E402
+
+from main import ContactDAO, contact, contact_json  # noqa: E402
+
+
+def make_rows(contacts, addresses):
+    rows = []
+    address_id = 0
+    for contact_id in range(1, contacts + 1):
+        head = (date(1980, 1, 1), "First %d" % contact_id, "Last %d" % contact_id, None, contact_id)
+        if addresses == 0:
+            rows.append(head + (None,) * 11)
+        for _ in range(addresses):
+            address_id += 1
+            rows.append(head + (contact_id, address_id, "CAN", "Mr", "K1A 0B1", "555-0100", "ON", "Ottawa",
+                                "%d Main Street" % address_id, None, "contact%d@example.com" % contact_id))
+    return rows
+
+
+def best_of(repeat, fn):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--contacts", type=int, default=20000)
+    parser.add_argument("--addresses", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    dao = ContactDAO()
+    rows = make_rows(args.contacts, args.addresses)
+    dict_rows = [dict(zip(ContactDAO.ROW_COLUMNS, row)) for row in rows]
+
+    def marshalled():
+        return json.dumps(marshal(list(dao.iter_contacts(dict_rows)), contact)) + "\n"
+
+    def compiled():
+        return contact_json.dumps_list(list(dao.iter_records(rows))) + "\n"
+
+    marshal_time, expected = best_of(args.repeat, marshalled)
+    compiled_time, body = best_of(args.repeat, compiled)
+    if body != expected:
+        sys.exit("compiled output differs from marshal output")
+
+    print("%d contacts, %d addresses each, %d bytes" % (args.contacts, args.addresses, len(body)))
+    print("marshal   %8.1f ms" % (marshal_time * 1000))
+    print("compiled  %8.1f ms  (%.1fx)" % (compiled_time * 1000, marshal_time / compiled_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Round trips and latency of ContactDAO.update as the number of addresses grows
+
+Runs against the database configured through the CONTACT_DB_* environment variables:
+
+    python benchmarks/update_round_trips.py --addresses 0 1 5 20 50 --repeat 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from common import ContactDAO, CountingCursor, counting_pool  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--addresses", type=int, nargs="+", default=[0, 1, 5, 20, 50])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    ContactDAO.CACHE_SIZE = 0
+    ContactDAO.pool = counting_pool()
+    dao = ContactDAO()
+
+    print("addresses  round_trips  mean_ms  p95_ms")
+    for count in args.addresses:
+        created = dao.create({"first_name": "Bench", "last_name": "Update",
+                              "addresses": [{"city": "City %d" % i} for i in range(count)]})
+        contact_id = created["contact_id"]
+        address_ids = [a["address_id"] for a in created.get("addresses") or []]
+        payload = {"first_name": "Bench",
+                   "addresses": [{"address_id": address_id, "email": "bench@example.com"} for address_id in address_ids] +
+                                [{"city": "New"}]}
+        timings = []
+        trips = []
+        for _ in range(args.repeat):
+            CountingCursor.statements = 0
+            start = time.perf_counter()
+            dao.update(contact_id, payload, partial=True)
+            timings.append((time.perf_counter() - start) * 1000)
+            trips.append(CountingCursor.statements)
+            # drop the address added by this round so every iteration sees the same contact
+            with dao.connection() as conn:
+                conn.execute("DELETE FROM " + dao.address_table_name + " WHERE contact_id = %s AND NOT address_id = ANY(%s)",
+                             (contact_id, address_ids))
+        dao.delete(contact_id)
+        p95 = statistics.quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]
+        print("%9d  %11d  %7.2f  %6.2f" % (count, max(trips), statistics.mean(timings), p95))
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,37 @@
+import argparse
+import atexit
+import base64
+import contextlib
+import contextvars
+import cProfile
+import csv
+import hashlib
+import io
+import itertools
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import date, datetime
+from json.encoder import encode_basestring_ascii
+from operator import attrgetter, itemgetter
+
 import psycopg
 from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb
+from psycopg_pool import ConnectionPool
 
-from flask import Flask, request
-from flask_restx import Api, Resource, fields
-from flask_restx import reqparse
+from flask import Flask, Response, current_app, g, request, stream_with_context
+from flask_restx import Api, Resource, fields, marshal
+from flask_restx import inputs, reqparse
+from werkzeug.http import quote_etag
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 app = Flask(__name__)
@@ -45,155 +73,1151 @@ contact = api.model(
     }
 )
 
+contact_batch = api.model(
+    "ContactBatch",
+    {
+        "contacts": fields.List(fields.Nested(contact), description="The contacts found, in the requested order"),
+        "missing": fields.List(fields.Raw, description="The requested identifiers that do not exist"),
+    }
+)
+
+
+class JsonSerializer(object):
+    """Writes a model as JSON text directly, byte for byte what marshal followed by json.dumps produces
+
+    The field encoders are resolved once from the model. getters maps every field name to a callable reading
+    the value from the serialized object, nested maps List(Nested) fields to the serializer of their items.
+    """
+
+    def __init__(self, model, getters, nested=None):
+        nested = nested or {}
+        self.fields = []
+        for name, field in model.items():
+            if isinstance(field, fields.Integer):
+                encode = self.encode_integer
+            elif isinstance(field, fields.String):
+                encode = self.encode_string
+            elif isinstance(field, fields.List) and isinstance(field.container, fields.Nested):
+                encode = nested[name].dumps_list
+            else:
+                raise ValueError("Cannot compile field {} of model {}".format(name, model.name))
+            self.fields.append((encode_basestring_ascii(name) + ": ", getters[name], encode))
+
+    @staticmethod
+    def encode_integer(value):
+        return "null" if value is None else str(int(value))
+
+    @staticmethod
+    def encode_string(value):
+        return "null" if value is None else encode_basestring_ascii(str(value))
+
+    def dumps(self, obj):
+        return "{" + ", ".join([prefix + encode(get(obj)) for prefix, get, encode in self.fields]) + "}"
+
+    def dumps_list(self, objs):
+        if objs is None:
+            return "null"
+        return "[" + ", ".join([self.dumps(obj) for obj in objs]) + "]"
+
+
+class ContactRecord(object):
+    """Contact grouped straight from cursor tuples, its addresses are kept as the raw rows"""
+
+    __slots__ = ("contact_id", "first_name", "last_name", "middle_name", "birth_date", "addresses")
+
+    def __init__(self, row):
+        self.birth_date, self.first_name, self.last_name, self.middle_name, self.contact_id = row[:5]
+        self.addresses = []
+
+    def get(self, name, default=None):
+        return getattr(self, name, default)
+
+
+class ContactCache(object):
+    """Cache backend interface used by ContactDAO.get
+
+    Values are (etag, contact) tuples keyed by contact_id. A shared backend (memcached, redis, ...)
+    implements these methods and is installed with ContactDAO.cache = MyCache().
+
+    Readers take the generation of a key before reading the database and pass it to set, which must drop the
+    value when the key was deleted in between. A backend returning None from generation gives no such guarantee.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def generation(self, key):
+        return None
+
+    def set(self, key, value, generation=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self):
+        return {}
+
+
+class LRUCache(ContactCache):
+    """In process cache bounded by entry count and age"""
+
+    def __init__(self, max_size=10000, ttl=60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # clock value of the last delete of each key, the oldest are forgotten and fall back to the floor
+        self.generations = OrderedDict()
+        self.clock = 0
+        self.floor = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_sets = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def generation(self, key):
+        with self.lock:
+            return self.generations.get(key, self.floor)
+
+    def set(self, key, value, generation=None):
+        with self.lock:
+            if generation is not None and self.generations.get(key, self.floor) != generation:
+                # deleted while the value was read, it may predate the change
+                self.stale_sets += 1
+                return
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+            self.clock += 1
+            self.generations[key] = self.clock
+            self.generations.move_to_end(key)
+            while len(self.generations) > self.max_size:
+                # raising the floor changes the generation of every forgotten key, pending sets of them are dropped
+                self.floor = self.generations.popitem(last=False)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generations.clear()
+            self.clock += 1
+            self.floor = self.clock
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "expirations": self.expirations, "invalidations": self.invalidations, "stale_sets": self.stale_sets,
+                    "size": len(self.entries), "max_size": self.max_size, "ttl": self.ttl}
+
+
+# timings of the request being served, None when nothing is recorded
+request_timings = contextvars.ContextVar("request_timings", default=None)
+slow_query_log = logging.getLogger("contact.slow_query")
+
+
+class RequestTimings(object):
+    """Seconds spent by one request in each span, plus the statements it sent"""
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.spans = OrderedDict()
+        self.queries = 0
+        self.rows = 0
+
+    def add(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self, total):
+        entries = []
+        for name, seconds in self.spans.items():
+            desc = ';desc="{} queries, {} rows"'.format(self.queries, self.rows) if name == "db" else ""
+            entries.append("{}{};dur={:.2f}".format(name, desc, seconds * 1000))
+        entries.append("total;dur={:.2f}".format(total * 1000))
+        return ", ".join(entries)
+
+
+def record_span(name, seconds):
+    timings = request_timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+class Span(object):
+    """Adds the time spent in the block to a span of the current request, a no-op outside instrumented requests"""
+
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record_span(self.name, time.perf_counter() - self.start)
+
+
+class InstrumentedCursor(psycopg.Cursor):
+    """Cursor timing every statement it sends, see ContactDAO.record_query"""
+
+    def execute(self, query, params=None, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            ContactDAO.record_query(query, time.perf_counter() - start, self.rowcount)
+
+    def executemany(self, query, params_seq, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, params_seq, **kwargs)
+        finally:
+            ContactDAO.record_query(query, time.perf_counter() - start, self.rowcount)
+
+
+class Metrics(object):
+    """Request, span and statement counters of the process, written in the Prometheus text format"""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.spans = {}
+        self.queries = {}
+
+    def observe_request(self, endpoint, method, status, seconds, timings):
+        with self.lock:
+            key = (endpoint, method, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.durations.get(endpoint)
+            if histogram is None:
+                # one count per bucket, then the sum and the count
+                histogram = self.durations[endpoint] = [0] * len(self.BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+            for name, spent in timings.spans.items():
+                self.spans[(endpoint, name)] = self.spans.get((endpoint, name), 0.0) + spent
+
+    @staticmethod
+    def query_id(sql):
+        return hashlib.sha1(sql.encode()).hexdigest()[:12]
+
+    def observe_query(self, sql, seconds, rows):
+        with self.lock:
+            stats = self.queries.get(sql)
+            if stats is None:
+                stats = self.queries[sql] = {"query_id": self.query_id(sql), "query": sql, "calls": 0,
+                                             "seconds": 0.0, "max_seconds": 0.0, "rows": 0}
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["rows"] += max(rows, 0)
+
+    def query_stats(self):
+        with self.lock:
+            return sorted((dict(stats) for stats in self.queries.values()), key=itemgetter("seconds"), reverse=True)
+
+    @staticmethod
+    def labels(**values):
+        return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                              for name, value in values.items()) + "}"
+
+    def render(self, gauges=None):
+        lines = []
+        with self.lock:
+            lines.append("# TYPE contact_http_requests_total counter")
+            for (endpoint, method, status), count in sorted(self.requests.items()):
+                lines.append("contact_http_requests_total" + self.labels(endpoint=endpoint, method=method, status=status) +
+                             " {}".format(count))
+            lines.append("# TYPE contact_http_request_duration_seconds histogram")
+            for endpoint, histogram in sorted(self.durations.items()):
+                for bound, count in zip(self.BUCKETS, histogram):
+                    lines.append("contact_http_request_duration_seconds_bucket" + self.labels(endpoint=endpoint, le=bound) +
+                                 " {}".format(count))
+                lines.append("contact_http_request_duration_seconds_bucket" + self.labels(endpoint=endpoint, le="+Inf") +
+                             " {}".format(histogram[-1]))
+                lines.append("contact_http_request_duration_seconds_sum" + self.labels(endpoint=endpoint) +
+                             " {:.6f}".format(histogram[-2]))
+                lines.append("contact_http_request_duration_seconds_count" + self.labels(endpoint=endpoint) +
+                             " {}".format(histogram[-1]))
+            lines.append("# TYPE contact_http_request_span_seconds_total counter")
+            for (endpoint, name), seconds in sorted(self.spans.items()):
+                lines.append("contact_http_request_span_seconds_total" + self.labels(endpoint=endpoint, span=name) +
+                             " {:.6f}".format(seconds))
+            # statements are labelled by a hash of their text, GET /stats/queries maps it back
+            for metric, key, fmt in (("contact_db_queries_total", "calls", "{}"),
+                                     ("contact_db_query_seconds_total", "seconds", "{:.6f}"),
+                                     ("contact_db_rows_total", "rows", "{}")):
+                lines.append("# TYPE " + metric + " counter")
+                for stats in self.queries.values():
+                    lines.append(metric + self.labels(query_id=stats["query_id"]) + " " + fmt.format(stats[key]))
+        for name, value in sorted((gauges or {}).items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append("# TYPE " + name + " gauge")
+                lines.append("{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+
+class SampledProfiler(object):
+    """Runs cProfile on a random share of the requests and accumulates the statistics per endpoint"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.stats = {}
+        self.samples = {}
+        self.lock = threading.Lock()
+        # one profiled request at a time, the others run untouched
+        self.active = threading.Lock()
+
+    def start(self):
+        if self.rate <= 0 or random.random() >= self.rate or not self.active.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler (a debugger, coverage) is already active
+            self.active.release()
+            return None
+        return profile
+
+    def stop(self, endpoint, profile):
+        profile.disable()
+        self.active.release()
+        with self.lock:
+            if endpoint in self.stats:
+                self.stats[endpoint].add(profile)
+            else:
+                self.stats[endpoint] = pstats.Stats(profile)
+            self.samples[endpoint] = self.samples.get(endpoint, 0) + 1
+
+    def endpoints(self):
+        with self.lock:
+            return dict(self.samples)
+
+    def report(self, endpoint, sort="cumulative", limit=40):
+        with self.lock:
+            stats = self.stats.get(endpoint)
+            if stats is None:
+                return None
+            stream = io.StringIO()
+            stats.stream = stream
+            stats.sort_stats(sort).print_stats(limit)
+            return "{} sampled requests\n{}".format(self.samples[endpoint], stream.getvalue())
+
+
 class ContactDAO(object):
-    DB_HOST = "localhost"
-    DB_USER = "pete"
-    DB_PASS = "pete"
+    DB_HOST = os.environ.get("CONTACT_DB_HOST", "localhost")
+    DB_USER = os.environ.get("CONTACT_DB_USER", "pete")
+    DB_PASS = os.environ.get("CONTACT_DB_PASS", "pete")
+
+    # connection pool settings, shared by every ContactDAO in the process
+    POOL_MIN_SIZE = int(os.environ.get("CONTACT_POOL_MIN_SIZE", "1"))
+    POOL_MAX_SIZE = int(os.environ.get("CONTACT_POOL_MAX_SIZE", "10"))
+    POOL_TIMEOUT = float(os.environ.get("CONTACT_POOL_TIMEOUT", "30"))
+
+    # read through cache for single contacts, a size of 0 turns it off
+    CACHE_SIZE = int(os.environ.get("CONTACT_CACHE_SIZE", "10000"))
+    CACHE_TTL = float(os.environ.get("CONTACT_CACHE_TTL", "60"))
+
+    # request spans, Server-Timing headers and metrics, statements slower than SLOW_QUERY_MS are logged (0 is off)
+    # and a PROFILE_RATE share of the requests is run under cProfile (0 is off)
+    INSTRUMENT = os.environ.get("CONTACT_INSTRUMENT", "1") not in ("0", "false", "no", "")
+    SLOW_QUERY_MS = float(os.environ.get("CONTACT_SLOW_QUERY_MS", "0"))
+    PROFILE_RATE = float(os.environ.get("CONTACT_PROFILE_RATE", "0"))
+
+    # listing settings, sort fields must be contact columns so a contact's rows stay together
+    SORT_FIELDS = ("first_name", "last_name", "middle_name", "contact_id")
+    MAX_PAGE_SIZE = 1000
+    MAX_BATCH_SIZE = 1000
+    STREAM_ITERSIZE = 2000
+    IMPORT_BATCH_SIZE = 5000
+    EXPORT_CHUNK_SIZE = 1 << 16
+
+    # "aggregate" has Postgres build each contact's JSON in the query, "materialized" reads it from the document
+    # column kept up to date by triggers, "off" groups the joined rows in Python
+    DOCUMENTS = os.environ.get("CONTACT_DOCUMENTS", "off")
+
+    # writable columns and their maximum lengths, used to check imported rows
+    CONTACT_COLUMNS = {"birth_date": None, "first_name": 50, "last_name": 50, "middle_name": 50}
+    ADDRESS_COLUMNS = {"country": 6, "title": 5, "postal_code": 15, "phone": 15, "province": 20, "city": 50,
+                       "street1": 100, "street2": 100, "email": 250}
+
+    # searchable address columns, the expression is indexed and the input normalized the same way
+    ADDRESS_SEARCH = {"email": ("lower(email)", str.lower),
+                      "city": ("lower(city)", str.lower),
+                      "province": ("lower(province)", str.lower),
+                      "postal_code": ("upper(replace(postal_code, ' ', ''))", lambda value: value.replace(" ", "").upper())}
 
     contact_table_name = "contact"
     address_table_name = "address"
+    version_table_name = "schema_version"
+    MIGRATION_LOCK_ID = 7243061
 
-    def create_tables(self, drop: bool = False):
-        create_contact_sql = f"CREATE TABLE IF NOT EXISTS {self.contact_table_name} ("
-        create_contact_sql += '"contact_id" serial PRIMARY KEY,'
-        create_contact_sql += '"birth_date" date,'
-        create_contact_sql += '"first_name" character varying(50),'
-        create_contact_sql += '"last_name" character varying(50),'
-        create_contact_sql += '"middle_name" character varying(50))'
-
-        create_address_sql = f"CREATE TABLE IF NOT EXISTS {self.address_table_name} ("
-        create_address_sql += '"address_id" serial PRIMARY KEY,'
-        create_address_sql += 'country character varying(6),'
-        create_address_sql += 'title character varying(5),'
-        create_address_sql += 'postal_code character varying(15),'
-        create_address_sql += 'phone character varying(15),'
-        create_address_sql += 'province character varying(20),'
-        create_address_sql += 'city character varying(50),'
-        create_address_sql += 'street1 character varying(100),'
-        create_address_sql += 'street2 character varying(100),'
-        create_address_sql += 'email character varying(250),'
-        create_address_sql += '"contact_id" integer)'
-
-        with psycopg.connect("user=" + self.DB_USER + " password=" + self.DB_PASS + " host=" + self.DB_HOST) as conn:
-            # Open a cursor to perform database operations
-            with conn.cursor() as cur:
+    pool = None
+    cache = None
+    metrics = None
+    profiler = None
+    # the threaded server can reach the lazy setup below from several first requests at once
+    setup_lock = threading.Lock()
+
+    @classmethod
+    def conninfo(cls):
+        return "user=" + cls.DB_USER + " password=" + cls.DB_PASS + " host=" + cls.DB_HOST
+
+    @classmethod
+    def get_pool(cls):
+        # lazily open one pool for the whole process, connections are checked before being handed out
+        pool = ContactDAO.pool
+        if pool is not None:
+            return pool
+        with ContactDAO.setup_lock:
+            if ContactDAO.pool is None:
+                instrumented = cls.INSTRUMENT or cls.SLOW_QUERY_MS > 0
+                ContactDAO.pool = ConnectionPool(cls.conninfo(),
+                                                 min_size=cls.POOL_MIN_SIZE,
+                                                 max_size=cls.POOL_MAX_SIZE,
+                                                 timeout=cls.POOL_TIMEOUT,
+                                                 check=ConnectionPool.check_connection,
+                                                 kwargs={"cursor_factory": InstrumentedCursor} if instrumented else None,
+                                                 name="contact",
+                                                 open=True)
+                atexit.register(ContactDAO.close_pool)
+            return ContactDAO.pool
+
+    @classmethod
+    def close_pool(cls):
+        with ContactDAO.setup_lock:
+            pool = ContactDAO.pool
+            ContactDAO.pool = None
+        if pool is not None:
+            pool.close()
+
+    @classmethod
+    def pool_stats(cls):
+        if cls.pool is None:
+            return {"pool_min": cls.POOL_MIN_SIZE, "pool_max": cls.POOL_MAX_SIZE, "pool_size": 0}
+        stats = cls.pool.get_stats()
+        stats["saturation"] = (stats.get("pool_size", 0) - stats.get("pool_available", 0)) / stats.get("pool_max", 1)
+        return stats
+
+    @contextlib.contextmanager
+    def connection(self):
+        start = time.perf_counter()
+        with self.get_pool().connection() as conn:
+            record_span("connect", time.perf_counter() - start)
+            yield conn
+
+    @classmethod
+    def get_metrics(cls):
+        if ContactDAO.metrics is None:
+            with ContactDAO.setup_lock:
+                if ContactDAO.metrics is None:
+                    ContactDAO.metrics = Metrics()
+        return ContactDAO.metrics
+
+    @classmethod
+    def get_profiler(cls):
+        if ContactDAO.profiler is None:
+            with ContactDAO.setup_lock:
+                if ContactDAO.profiler is None:
+                    ContactDAO.profiler = SampledProfiler(cls.PROFILE_RATE)
+        return ContactDAO.profiler
+
+    @classmethod
+    def record_query(cls, query, seconds, rows):
+        """Account a statement to the current request, the process metrics and the slow query log"""
+        sql = query if isinstance(query, str) else str(query)
+        if len(sql) == 0:
+            # the pool's connection check, already part of the connect span
+            return
+        timings = request_timings.get()
+        if timings is not None:
+            timings.add("db", seconds)
+            timings.queries += 1
+            timings.rows += max(rows, 0)
+        if cls.INSTRUMENT:
+            cls.get_metrics().observe_query(sql, seconds, rows)
+        if 0 < cls.SLOW_QUERY_MS <= seconds * 1000:
+            slow_query_log.warning("slow query %.1f ms, %d rows, endpoint %s: %s", seconds * 1000, rows,
+                                   None if timings is None else timings.endpoint, sql)
+
+    @classmethod
+    def get_cache(cls):
+        if ContactDAO.cache is None and cls.CACHE_SIZE > 0:
+            with ContactDAO.setup_lock:
+                if ContactDAO.cache is None:
+                    ContactDAO.cache = LRUCache(cls.CACHE_SIZE, cls.CACHE_TTL)
+        return ContactDAO.cache
+
+    @classmethod
+    def cache_stats(cls):
+        cache = cls.get_cache()
+        return {} if cache is None else cache.stats()
+
+    @staticmethod
+    def cache_key(contact_id):
+        try:
+            return int(contact_id)
+        except (TypeError, ValueError):
+            return None
+
+    def invalidate(self, contact_id):
+        cache = self.get_cache()
+        key = self.cache_key(contact_id)
+        if cache is not None and key is not None:
+            cache.delete(key)
+
+    @staticmethod
+    def etag(found):
+        return hashlib.sha1(json.dumps(found, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def masked_etag(etag, mask):
+        # a masked body is another representation of the contact, it must not validate the full one
+        if mask is None:
+            return etag
+        return hashlib.sha1((etag + mask).encode()).hexdigest()
+
+    def migrations(self):
+        """Numbered schema changes, append new ones and never edit one that has been released
+
+        The statements are written out rather than built from the models and settings, which may change after a
+        migration has run; only the table names are filled in.
+        """
+        touch = ("UPDATE " + self.contact_table_name + " SET updated_at = now() WHERE updated_at < now() AND " +
+                 "contact_id IN (")
+        return [
+            (1, "create contact and address tables", [
+                "CREATE TABLE IF NOT EXISTS " + self.contact_table_name + " (" +
+                '"contact_id" serial PRIMARY KEY,' +
+                '"birth_date" date,' +
+                '"first_name" character varying(50),' +
+                '"last_name" character varying(50),' +
+                '"middle_name" character varying(50))',
+
+                "CREATE TABLE IF NOT EXISTS " + self.address_table_name + " (" +
+                '"address_id" serial PRIMARY KEY,' +
+                'country character varying(6),' +
+                'title character varying(5),' +
+                'postal_code character varying(15),' +
+                'phone character varying(15),' +
+                'province character varying(20),' +
+                'city character varying(50),' +
+                'street1 character varying(100),' +
+                'street2 character varying(100),' +
+                'email character varying(250),' +
+                '"contact_id" integer)',
+            ]),
+            (2, "index addresses by contact and cascade contact deletes", [
+                # NOT VALID keeps databases holding orphaned addresses migratable, new rows are still checked
+                "ALTER TABLE " + self.address_table_name + " ADD CONSTRAINT " + self.address_table_name +
+                "_contact_id_fkey FOREIGN KEY (contact_id) REFERENCES " + self.contact_table_name +
+                " (contact_id) ON DELETE CASCADE NOT VALID",
+                "CREATE INDEX IF NOT EXISTS " + self.address_table_name + "_contact_id_idx ON " +
+                self.address_table_name + " (contact_id)",
+
+                # same expressions as sort_key so keyset pages are index scans
+                "CREATE INDEX IF NOT EXISTS " + self.contact_table_name + "_first_name_idx ON " +
+                self.contact_table_name + " (COALESCE(first_name, ''), contact_id)",
+                "CREATE INDEX IF NOT EXISTS " + self.contact_table_name + "_last_name_idx ON " +
+                self.contact_table_name + " (COALESCE(last_name, ''), contact_id)",
+                "CREATE INDEX IF NOT EXISTS " + self.contact_table_name + "_middle_name_idx ON " +
+                self.contact_table_name + " (COALESCE(middle_name, ''), contact_id)",
+            ]),
+            (3, "search indexes on names and addresses", [
+                # same expressions as name_document and ADDRESS_SEARCH
+                "CREATE INDEX IF NOT EXISTS " + self.contact_table_name + "_name_search_idx ON " +
+                self.contact_table_name + " USING gin ((to_tsvector('simple', COALESCE(first_name, '') || ' ' || " +
+                "COALESCE(middle_name, '') || ' ' || COALESCE(last_name, ''))))",
+                "CREATE INDEX IF NOT EXISTS " + self.address_table_name + "_email_search_idx ON " +
+                self.address_table_name + " ((lower(email)))",
+                "CREATE INDEX IF NOT EXISTS " + self.address_table_name + "_city_search_idx ON " +
+                self.address_table_name + " ((lower(city)))",
+                "CREATE INDEX IF NOT EXISTS " + self.address_table_name + "_province_search_idx ON " +
+                self.address_table_name + " ((lower(province)))",
+                "CREATE INDEX IF NOT EXISTS " + self.address_table_name + "_postal_code_search_idx ON " +
+                self.address_table_name + " ((upper(replace(postal_code, ' ', ''))))",
+            ]),
+            (4, "modification timestamps", [
+                "ALTER TABLE " + self.contact_table_name +
+                " ADD COLUMN IF NOT EXISTS updated_at timestamp with time zone NOT NULL DEFAULT now()",
+                "ALTER TABLE " + self.address_table_name +
+                " ADD COLUMN IF NOT EXISTS updated_at timestamp with time zone NOT NULL DEFAULT now()",
+                "CREATE OR REPLACE FUNCTION " + self.contact_table_name + "_touch_updated_at() RETURNS trigger " +
+                "LANGUAGE plpgsql AS $$ BEGIN NEW.updated_at := now(); RETURN NEW; END $$",
+                "CREATE TRIGGER " + self.contact_table_name + "_touch_updated_at BEFORE UPDATE ON " +
+                self.contact_table_name + " FOR EACH ROW EXECUTE FUNCTION " + self.contact_table_name + "_touch_updated_at()",
+                "CREATE TRIGGER " + self.address_table_name + "_touch_updated_at BEFORE UPDATE ON " +
+                self.address_table_name + " FOR EACH ROW EXECUTE FUNCTION " + self.contact_table_name + "_touch_updated_at()",
+                "CREATE INDEX IF NOT EXISTS " + self.contact_table_name + "_updated_at_idx ON " +
+                self.contact_table_name + " (updated_at)",
+            ]),
+            (5, "address changes touch their contact", [
+                # once per statement so COPY stays set based, contacts already touched by this transaction
+                # (created with their addresses, or updated along with them) are not written again
+                "CREATE OR REPLACE FUNCTION " + self.address_table_name + "_touch_contact() RETURNS trigger " +
+                "LANGUAGE plpgsql AS $$ BEGIN " +
+                # a transition table only exists for the events that define it
+                "IF TG_OP = 'INSERT' THEN " + touch + "SELECT contact_id FROM new_rows); " +
+                "ELSIF TG_OP = 'DELETE' THEN " + touch + "SELECT contact_id FROM old_rows); " +
+                "ELSE " + touch + "SELECT contact_id FROM new_rows UNION SELECT contact_id FROM old_rows); " +
+                "END IF; RETURN NULL; END $$",
+                "CREATE TRIGGER " + self.address_table_name + "_touch_contact_insert AFTER INSERT ON " +
+                self.address_table_name + " REFERENCING NEW TABLE AS new_rows " +
+                "FOR EACH STATEMENT EXECUTE FUNCTION " + self.address_table_name + "_touch_contact()",
+                "CREATE TRIGGER " + self.address_table_name + "_touch_contact_update AFTER UPDATE ON " +
+                self.address_table_name + " REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows " +
+                "FOR EACH STATEMENT EXECUTE FUNCTION " + self.address_table_name + "_touch_contact()",
+                "CREATE TRIGGER " + self.address_table_name + "_touch_contact_delete AFTER DELETE ON " +
+                self.address_table_name + " REFERENCING OLD TABLE AS old_rows " +
+                "FOR EACH STATEMENT EXECUTE FUNCTION " + self.address_table_name + "_touch_contact()",
+            ]),
+        ]
+
+    def document_statements(self):
+        """Schema of CONTACT_DOCUMENTS=materialized: the document column and the triggers keeping it up to date
+
+        Not a numbered migration, the triggers write every imported contact twice and add an UPDATE of the
+        contacts to every address change, so only databases serving materialized documents install them.
+        """
+        refresh = ("UPDATE " + self.contact_table_name + " c SET document = " + self.document_function() + "(c) " +
+                   "WHERE c.contact_id IN (")
+        return [
+            "ALTER TABLE " + self.contact_table_name + " ADD COLUMN IF NOT EXISTS document json",
+            # written out like the migrations, after a model change rebuild them with --drop-documents then --documents
+            "CREATE OR REPLACE FUNCTION " + self.document_function() + "(c " + self.contact_table_name + ") " +
+            "RETURNS json LANGUAGE sql STABLE AS $$ SELECT json_build_object(" +
+            "'contact_id', c.contact_id, 'first_name', c.first_name, 'last_name', c.last_name, " +
+            "'middle_name', c.middle_name, 'addresses', COALESCE((SELECT json_agg(json_build_object(" +
+            "'address_id', a.address_id, 'contact_id', a.contact_id, 'country', a.country, 'title', a.title, " +
+            "'postal_code', a.postal_code, 'phone', a.phone, 'province', a.province, 'city', a.city, " +
+            "'street1', a.street1, 'street2', a.street2, 'email', a.email) ORDER BY a.address_id) " +
+            "FROM " + self.address_table_name + " a WHERE a.contact_id = c.contact_id), '[]')) $$",
+            "UPDATE " + self.contact_table_name + " SET document = " + self.document_function() + "(" +
+            self.contact_table_name + ")",
+
+            # contacts rebuild their own document when one of its fields changes
+            "CREATE OR REPLACE FUNCTION " + self.contact_table_name + "_document_refresh() RETURNS trigger " +
+            "LANGUAGE plpgsql AS $$ BEGIN NEW.document := " + self.document_function() + "(NEW); RETURN NEW; END $$",
+            "CREATE TRIGGER " + self.contact_table_name + "_document_refresh BEFORE INSERT OR UPDATE OF " +
+            "contact_id, first_name, last_name, middle_name ON " + self.contact_table_name +
+            " FOR EACH ROW EXECUTE FUNCTION " + self.contact_table_name + "_document_refresh()",
+
+            # address changes rebuild the documents of their contacts once per statement, so COPY stays set based
+            "CREATE OR REPLACE FUNCTION " + self.address_table_name + "_document_refresh() RETURNS trigger " +
+            "LANGUAGE plpgsql AS $$ BEGIN " +
+            # a transition table only exists for the events that define it
+            "IF TG_OP = 'INSERT' THEN " + refresh + "SELECT contact_id FROM new_rows); " +
+            "ELSIF TG_OP = 'DELETE' THEN " + refresh + "SELECT contact_id FROM old_rows); " +
+            "ELSE " + refresh + "SELECT contact_id FROM new_rows UNION SELECT contact_id FROM old_rows); " +
+            "END IF; RETURN NULL; END $$",
+
+            # a trigger with transition tables handles a single event
+            "CREATE TRIGGER " + self.address_table_name + "_document_insert AFTER INSERT ON " +
+            self.address_table_name + " REFERENCING NEW TABLE AS new_rows " +
+            "FOR EACH STATEMENT EXECUTE FUNCTION " + self.address_table_name + "_document_refresh()",
+            "CREATE TRIGGER " + self.address_table_name + "_document_update AFTER UPDATE ON " +
+            self.address_table_name + " REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows " +
+            "FOR EACH STATEMENT EXECUTE FUNCTION " + self.address_table_name + "_document_refresh()",
+            "CREATE TRIGGER " + self.address_table_name + "_document_delete AFTER DELETE ON " +
+            self.address_table_name + " REFERENCING OLD TABLE AS old_rows " +
+            "FOR EACH STATEMENT EXECUTE FUNCTION " + self.address_table_name + "_document_refresh()",
+        ]
+
+    def drop_document_statements(self):
+        return [
+            "DROP TRIGGER IF EXISTS " + self.address_table_name + "_document_" + event + " ON " + self.address_table_name
+            for event in ("insert", "update", "delete")
+        ] + [
+            "DROP FUNCTION IF EXISTS " + self.address_table_name + "_document_refresh()",
+            "DROP TRIGGER IF EXISTS " + self.contact_table_name + "_document_refresh ON " + self.contact_table_name,
+            "DROP FUNCTION IF EXISTS " + self.contact_table_name + "_document_refresh()",
+            "ALTER TABLE " + self.contact_table_name + " DROP COLUMN IF EXISTS document",
+            "DROP FUNCTION IF EXISTS " + self.document_function() + "(" + self.contact_table_name + ")",
+        ]
+
+    def documents_installed(self, conn):
+        return conn.execute("SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = %s::regclass AND tgname = %s)",
+                            (self.contact_table_name, self.contact_table_name + "_document_refresh")).fetchone()[0]
+
+    def migrate(self, drop: bool = False, documents: bool = None):
+        """Bring the schema up to date and return the versions applied
+
+        documents installs (True) or removes (False) the materialized contact documents, by default they are
+        installed when DOCUMENTS is "materialized" and otherwise left as they are.
+        """
+        applied = []
+        with self.connection() as conn:
+            with conn.transaction():
+                # serialize concurrent migrations from several processes
+                conn.execute("SELECT pg_advisory_xact_lock(%s)", (self.MIGRATION_LOCK_ID,))
                 if drop:
-                    # remove tables if found
-                    cur.execute("DROP TABLE IF EXISTS " + self.address_table_name)
-                    cur.execute("DROP TABLE IF EXISTS " + self.contact_table_name)
-                # Execute a command: this creates a new table
-                cur.execute(create_contact_sql)
-                cur.execute(create_address_sql)
-            conn.commit()
+                    # remove tables if found, the document function takes contact rows and has to go first
+                    conn.execute("DROP TABLE IF EXISTS " + self.address_table_name)
+                    conn.execute("DROP FUNCTION IF EXISTS " + self.document_function() + "(" + self.contact_table_name + ")")
+                    conn.execute("DROP TABLE IF EXISTS " + self.contact_table_name)
+                    conn.execute("DROP TABLE IF EXISTS " + self.version_table_name)
+                conn.execute("CREATE TABLE IF NOT EXISTS " + self.version_table_name + " (" +
+                             "version integer PRIMARY KEY," +
+                             "description text," +
+                             "applied_at timestamp with time zone DEFAULT now())")
+                current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM " + self.version_table_name).fetchone()[0]
+                for version, description, statements in self.migrations():
+                    if version <= current:
+                        continue
+                    for statement in statements:
+                        conn.execute(statement)
+                    conn.execute("INSERT INTO " + self.version_table_name + " (version, description) VALUES (%s, %s)",
+                                 (version, description))
+                    applied.append(version)
+                if documents is None and self.DOCUMENTS == "materialized":
+                    documents = True
+                if documents is not None and documents != self.documents_installed(conn):
+                    for statement in self.document_statements() if documents else self.drop_document_statements():
+                        conn.execute(statement)
+        return applied
+
+    def schema_version(self):
+        with self.connection() as conn:
+            return conn.execute("SELECT COALESCE(MAX(version), 0) FROM " + self.version_table_name).fetchone()[0]
 
     def __init__(self):
-        self.create_tables()
         self.counter = 0
         self.contacts = []
 
-    def get_all(self):
-        # http://127.0.0.1:5000/contacts/?field=first_name&direction=desc
-        parser = reqparse.RequestParser()
-        parser.add_argument('field', type=str, help='Order By Field', location='args')
-        parser.add_argument('direction', type=str, help='Order By Direction', location='args')
-        args = parser.parse_args()
-        field = args["field"] if "field" in args and args["field"] is not None else self .contact_table_name + ".last_name"
-        direction = args["direction"] if "direction" in args and args["direction"] is not None else "DESC"
+    # column order of select_columns, ContactRecord and address_json read rows by position
+    ROW_COLUMNS = ("birth_date", "first_name", "last_name", "middle_name", "contact_id", "add_contact_id", "address_id",
+                   "country", "title", "postal_code", "phone", "province", "city", "street1", "street2", "email")
+
+    def select_columns(self):
+        return ("SELECT " + self.contact_table_name + ".birth_date, " +
+                self.contact_table_name + ".first_name, " +
+                self.contact_table_name + ".last_name, " +
+                self.contact_table_name + ".middle_name, " +
+                self.contact_table_name + ".contact_id,  " +
+
+                self.address_table_name + ".contact_id as add_contact_id, " +
+                self.address_table_name + ".address_id, " +
+                self.address_table_name + ".country, " +
+                self.address_table_name + ".title, " +
+                self.address_table_name + ".postal_code, " +
+                self.address_table_name + ".phone, " +
+                self.address_table_name + ".province, " +
+                self.address_table_name + ".city, " +
+                self.address_table_name + ".street1, " +
+                self.address_table_name + ".street2, " +
+                self.address_table_name + ".email ")
+
+    def sort_key(self, field, table=None):
+        # keyset pagination needs a NULL free sort key, the contact_id breaks ties
+        column = field if table is None else table + "." + field
+        if field == "contact_id":
+            return column
+        return "COALESCE(" + column + ", '')"
+
+    def list_query(self, field=None, direction=None, limit=None, after=None, filters=None, documents=False):
+        """Build the listing SQL, one row per address, or with documents one (sort value, contact_id, JSON) row
+        per contact"""
+        field = field if field is not None else self.contact_table_name + ".last_name"
+        if field.startswith(self.contact_table_name + "."):
+            field = field[len(self.contact_table_name) + 1:]
+        if field not in self.SORT_FIELDS:
+            api.abort(400, "Cannot order by {}".format(field))
+        direction = direction.upper() if direction is not None else "DESC"
+        if direction not in ("ASC", "DESC"):
+            api.abort(400, "Order By Direction must be ASC or DESC")
+        if limit is not None and (limit < 1 or limit > self.MAX_PAGE_SIZE):
+            api.abort(400, "limit must be between 1 and {}".format(self.MAX_PAGE_SIZE))
+
+        # pick the page of contacts first, then join their addresses
+        page_sql = "SELECT * FROM " + self.contact_table_name
+        conditions = []
+        params = []
+        for condition, condition_params in filters or []:
+            conditions.append(condition)
+            params += condition_params
+        if after is not None:
+            after_value, after_id = self.decode_cursor(after)
+            if field == "contact_id":
+                conditions.append("contact_id " + (">" if direction == "ASC" else "<") + " %s")
+                params.append(after_id)
+            else:
+                conditions.append("(" + self.sort_key(field) + ", contact_id) " +
+                                  (">" if direction == "ASC" else "<") + " (%s, %s)")
+                params += [after_value, after_id]
+        if len(conditions) > 0:
+            page_sql += " WHERE " + " AND ".join(conditions)
+        page_sql += " ORDER BY " + self.sort_key(field) + " " + direction
+        if field != "contact_id":
+            page_sql += ", contact_id " + direction
+        if limit is not None:
+            page_sql += " LIMIT %s"
+            params.append(limit)
+
+        order_by = self.sort_key(field, self.contact_table_name) + " " + direction
+        if field != "contact_id":
+            order_by += ", " + self.contact_table_name + ".contact_id " + direction
+        if documents:
+            sql = ("SELECT " + self.sort_key(field, self.contact_table_name) + ", " + self.contact_table_name +
+                   ".contact_id, " + self.document_column(self.contact_table_name) +
+                   " FROM (" + page_sql + ") AS " + self.contact_table_name + " ORDER BY " + order_by)
+            return sql, params, field
+        sql = (self.select_columns() +
+               " FROM (" + page_sql + ") AS " + self.contact_table_name + " left join " + self.address_table_name + " on " +
+               self.contact_table_name + ".contact_id = " + self.address_table_name + ".contact_id ORDER BY " + order_by +
+               # addresses in the same order as the documents
+               ", " + self.address_table_name + ".address_id")
+        return sql, params, field
+
+    @staticmethod
+    def encode_cursor(value, contact_id):
+        return base64.urlsafe_b64encode(json.dumps([value, contact_id]).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            value, contact_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            return value, int(contact_id)
+        except (ValueError, TypeError):
+            api.abort(400, "Invalid cursor {}".format(cursor))
+
+    def name_document(self):
+        return ("to_tsvector('simple', COALESCE(first_name, '') || ' ' || COALESCE(middle_name, '') || ' ' || "
+                "COALESCE(last_name, ''))")
+
+    def search_filters(self, name=None, email=None, city=None, province=None, postal_code=None):
+        """Build list_query filters, each one matches an index created by the search migration"""
+        filters = []
+        if name is not None:
+            # every word of the query must prefix one of the contact's names
+            words = re.findall(r"\w+", name)
+            if len(words) == 0:
+                api.abort(400, "name must contain a letter or a digit")
+            filters.append((self.name_document() + " @@ to_tsquery('simple', %s)",
+                            [" & ".join(word + ":*" for word in words)]))
+        address_conditions = []
+        address_params = []
+        for value, column in ((email, "email"), (city, "city"), (province, "province"), (postal_code, "postal_code")):
+            if value is not None:
+                expression, normalize = self.ADDRESS_SEARCH[column]
+                address_conditions.append(expression + " = %s")
+                address_params.append(normalize(value))
+        if len(address_conditions) > 0:
+            # all the address filters have to match the same address
+            filters.append(("EXISTS (SELECT 1 FROM " + self.address_table_name + " WHERE " +
+                            self.address_table_name + ".contact_id = " + self.contact_table_name + ".contact_id AND " +
+                            " AND ".join(address_conditions) + ")", address_params))
+        return filters
+
+    def document_function(self):
+        return self.contact_table_name + "_document"
+
+    def document_expression(self, table, extra=()):
+        """SQL building the JSON of a contact row of table, with the fields of the contact model in their order
+        followed by the extra columns"""
+        entries = []
+        for name, field in contact.items():
+            if isinstance(field, fields.List):
+                addresses = ", ".join("'" + key + "', a." + key for key in address)
+                entries.append("'" + name + "', COALESCE((SELECT json_agg(json_build_object(" + addresses +
+                               ") ORDER BY a.address_id) FROM " + self.address_table_name + " a WHERE a.contact_id = " +
+                               table + ".contact_id), '[]')")
+            else:
+                entries.append("'" + name + "', " + table + "." + name)
+        entries += ["'" + name + "', " + table + "." + name for name in extra]
+        return "json_build_object(" + ", ".join(entries) + ")"
+
+    def document_column(self, table):
+        # read as text, the document is passed through without being parsed
+        if self.DOCUMENTS == "materialized":
+            return table + ".document::text"
+        return "(" + self.document_expression(table) + ")::text"
+
+    def get_all_documents(self, field=None, direction=None, limit=None, after=None, filters=None):
+        """Same listing as get_all, as the JSON text of every contact built by Postgres"""
+        sql, params, field = self.list_query(field, direction, limit, after, filters, documents=True)
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                with Span("fetch"):
+                    rows = cur.fetchall()
+        last = rows[-1] if len(rows) > 0 else (None, None)
+        return [row[2] for row in rows], self.page_cursor(len(rows), last[0], last[1], limit, after, filters)
+
+    def iter_documents(self, field=None, direction=None, limit=None, after=None, filters=None):
+        """Same listing as iter_all, yielding the JSON text of one contact at a time"""
+        sql, params, field = self.list_query(field, direction, limit, after, filters, documents=True)
+        return self.iter_document_query(sql, params)
+
+    def iter_document_query(self, sql, params):
+        with self.connection() as conn:
+            with conn.cursor(name="contact_document_stream") as cur:
+                cur.itersize = self.STREAM_ITERSIZE
+                cur.execute(sql, params)
+                for row in cur:
+                    yield row[2]
+
+    def get_document(self, contact_id):
+        """Return (etag, JSON text) of a contact built by Postgres, read straight from the database"""
+        key = self.contact_key(contact_id)
+        with self.connection() as conn:
+            row = conn.execute(self.select_document_sql(), (key,)).fetchone()
+        return self.document_entry(contact_id, row)
+
+    def select_document_sql(self):
+        return ("SELECT " + self.document_column(self.contact_table_name) + " FROM " + self.contact_table_name +
+                " WHERE contact_id = %s")
 
-        with psycopg.connect("user=" + self.DB_USER + " password=" + self.DB_PASS + " host=" + self.DB_HOST) as conn:
+    @staticmethod
+    def document_entry(contact_id, row):
+        if row is None:
+            api.abort(404, "Contact {} doesn't exist".format(contact_id))
+        return hashlib.sha1(row[0].encode()).hexdigest(), row[0]
+
+    def get_all(self, field=None, direction=None, limit=None, after=None, filters=None):
+        # http://127.0.0.1:5000/contacts/?field=first_name&direction=desc&limit=50&after=<cursor>
+        sql, params, field = self.list_query(field, direction, limit, after, filters)
+        with self.connection() as conn:
             with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute("SELECT " + self.contact_table_name + ".birth_date, " +
-                            self.contact_table_name + ".first_name, " +
-                            self.contact_table_name + ".last_name, " +
-                            self.contact_table_name + ".middle_name, " +
-                            self.contact_table_name + ".contact_id,  " +
-
-                            self.address_table_name + ".contact_id as add_contact_id, " +
-                            self.address_table_name + ".address_id, " +
-                            self.address_table_name + ".country, " +
-                            self.address_table_name + ".title, " +
-                            self.address_table_name + ".postal_code, " +
-                            self.address_table_name + ".phone, " +
-                            self.address_table_name + ".province, " +
-                            self.address_table_name + ".city, " +
-                            self.address_table_name + ".street1, " +
-                            self.address_table_name + ".street2, " +
-                            self.address_table_name + ".email " +
-
-                            " FROM " + self.contact_table_name + " left join " + self.address_table_name + " on " +
-                            self.contact_table_name + ".contact_id = " + self.address_table_name + ".contact_id ORDER BY " + field + " " + direction)
-                contacts = cur.fetchall()
-                if len(contacts) == 0:
-                    api.abort(404, "Contacts Empty")
-
-                c1 = {"birth_date": contacts[0].get("birth_date", None),
-                      "first_name": contacts[0].get("first_name", None),
-                      "last_name": contacts[0].get("last_name", None),
-                      "middle_name": contacts[0].get("middle_name", None),
-                      "contact_id": contacts[0].get("contact_id", None),
-                      }
-
-                listing = []
+                cur.execute(sql, params)
+                with Span("fetch"):
+                    rows = cur.fetchall()
+        with Span("transform"):
+            listing = list(self.iter_contacts(rows))
+        return listing, self.next_cursor(listing, field, limit, after, filters)
+
+    def get_all_records(self, field=None, direction=None, limit=None, after=None, filters=None):
+        """Same listing as get_all, as ContactRecords read from plain tuple rows"""
+        sql, params, field = self.list_query(field, direction, limit, after, filters)
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(sql, params)
+                with Span("fetch"):
+                    rows = cur.fetchall()
+        with Span("transform"):
+            listing = list(self.iter_records(rows))
+        return listing, self.next_cursor(listing, field, limit, after, filters)
+
+    @staticmethod
+    def iter_records(rows):
+        current = None
+        for row in rows:
+            if current is None or row[4] != current.contact_id:
+                if current is not None:
+                    yield current
+                current = ContactRecord(row)
+            if row[5] is not None:
+                current.addresses.append(row)
+        if current is not None:
+            yield current
+
+    def next_cursor(self, listing, field, limit, after, filters=None):
+        last = listing[-1] if len(listing) > 0 else {}
+        return self.page_cursor(len(listing), last.get(field), last.get("contact_id"), limit, after, filters)
+
+    def page_cursor(self, count, last_value, last_id, limit, after, filters=None):
+        self.check_listing(count, after, filters)
+        if limit is None or count < limit:
+            return None
+        return self.encode_cursor(last_value or "", last_id)
+
+    def check_listing(self, count, after, filters=None):
+        # an empty search is a valid answer, an empty listing is not
+        if count == 0 and after is None and not filters:
+            api.abort(404, "Contacts Empty")
+
+    def iter_all(self, field=None, direction=None, limit=None, after=None, filters=None):
+        # same listing as get_all, read through a server side cursor and yielded one contact at a time
+        sql, params, field = self.list_query(field, direction, limit, after, filters)
+        return self.iter_query(sql, params)
+
+    def iter_query(self, sql, params):
+        with self.connection() as conn:
+            with conn.cursor(name="contact_stream", row_factory=dict_row) as cur:
+                cur.itersize = self.STREAM_ITERSIZE
+                cur.execute(sql, params)
+                yield from self.iter_contacts(cur)
+
+    def iter_contacts(self, rows):
+        # rows arrive ordered by contact, fold each run of address rows into its contact
+        c1 = None
+        addresses = []
+        for c in rows:
+            if c1 is None or c.get("contact_id") != c1.get("contact_id"):
+                if c1 is not None:
+                    c1["addresses"] = addresses
+                    yield c1
                 addresses = []
-                temp_a = {}
-                for c in contacts:
-                    if c.get("contact_id") != c1.get("contact_id"):
-                        c1["addresses"] = addresses
-                        listing.append(c1)
-                        addresses = []
-                        c1 = {"birth_date": c.get("birth_date", None),
-                              "first_name": c.get("first_name", None),
-                              "last_name": c.get("last_name", None),
-                              "middle_name": c.get("middle_name", None),
-                              "contact_id": c.get("contact_id", None),
-                              "addresses": None}
-
-                    if c.get("add_contact_id") is not None:
-                        temp_a = {"address_id": c.get("address_id", None), "country": c.get("country", None),
-                             "title": c.get("title", None), "postal_code": c.get("postal_code", None),
-                             "phone": c.get("phone", None), "province": c.get("province", None),
-                             "city": c.get("city", None), "street1": c.get("street1", None),
-                             "street2": c.get("street2", None), "email": c.get("email", None),
-                             "contact_id": c.get("add_contact_id", None)}
-                        addresses.append(temp_a)
-                c1["addresses"] = addresses
-                listing.append(c1)
-                return listing
+                c1 = {"birth_date": c.get("birth_date", None),
+                      "first_name": c.get("first_name", None),
+                      "last_name": c.get("last_name", None),
+                      "middle_name": c.get("middle_name", None),
+                      "contact_id": c.get("contact_id", None),
+                      "addresses": None}
 
+            if c.get("add_contact_id") is not None:
+                temp_a = {"address_id": c.get("address_id", None), "country": c.get("country", None),
+                          "title": c.get("title", None), "postal_code": c.get("postal_code", None),
+                          "phone": c.get("phone", None), "province": c.get("province", None),
+                          "city": c.get("city", None), "street1": c.get("street1", None),
+                          "street2": c.get("street2", None), "email": c.get("email", None),
+                          "contact_id": c.get("add_contact_id", None)}
+                addresses.append(temp_a)
+        if c1 is not None:
+            c1["addresses"] = addresses
+            yield c1
 
     def get(self, contact_id):
-        with psycopg.connect("user=" + self.DB_USER + " password=" + self.DB_PASS + " host=" + self.DB_HOST) as conn:
+        return self.get_versioned(contact_id)[1]
+
+    def get_versioned(self, contact_id):
+        """Return (etag, contact), served from the cache when possible"""
+        key = self.contact_key(contact_id)
+        entry = self.cached(key)
+        if entry is not None:
+            return entry
+
+        generation = self.generation(key)
+        with self.connection() as conn:
             with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute("SELECT " + self.contact_table_name + ".birth_date, " +
-                            self.contact_table_name + ".first_name, " +
-                            self.contact_table_name + ".last_name, " +
-                            self.contact_table_name + ".middle_name, " +
-                            self.contact_table_name + ".contact_id,  " +
-
-                            self.address_table_name + ".contact_id as add_contact_id, " +
-                            self.address_table_name + ".address_id, " +
-                            self.address_table_name + ".country, " +
-                            self.address_table_name + ".title, " +
-                            self.address_table_name + ".postal_code, " +
-                            self.address_table_name + ".phone, " +
-                            self.address_table_name + ".province, " +
-                            self.address_table_name + ".city, " +
-                            self.address_table_name + ".street1, " +
-                            self.address_table_name + ".street2, " +
-                            self.address_table_name + ".email " +
-
-                            " FROM " + self.contact_table_name + " left join " + self.address_table_name + " on " +
-                            self.contact_table_name + ".contact_id = " + self.address_table_name + ".contact_id where " +
-                            self.contact_table_name + ".contact_id in (%s)",(contact_id,))
-                contacts = cur.fetchall()
-                if len(contacts) == 0:
-                    api.abort(404, "Contact {} doesn't exist".format(contact_id))
-
-                return self.parse_db_contact(contacts)
+                cur.execute(self.select_contacts_sql(self.contact_table_name + ".contact_id in (%s)"), (key,))
+                with Span("fetch"):
+                    contacts = cur.fetchall()
+        return self.store(key, contacts, generation)
 
-    def parse_db_contact(self, contacts):
-        addresses = []
+    def contact_key(self, contact_id):
+        key = self.cache_key(contact_id)
+        if key is None:
+            api.abort(404, "Contact {} doesn't exist".format(contact_id))
+        return key
+
+    def cached(self, key):
+        cache = self.get_cache()
+        return None if cache is None else cache.get(key)
+
+    def generation(self, key):
+        # taken before reading the database, so a contact changed meanwhile is not cached
+        cache = self.get_cache()
+        return None if cache is None else cache.generation(key)
+
+    def store(self, key, contacts, generation=None):
+        if len(contacts) == 0:
+            api.abort(404, "Contact {} doesn't exist".format(key))
+        with Span("transform"):
+            found = self.parse_db_contact(contacts)
+            entry = (self.etag(found), found)
+        cache = self.get_cache()
+        if cache is not None:
+            cache.set(key, entry, generation)
+        return entry
+
+    def select_contacts_sql(self, where):
+        return (self.select_columns() +
+                " FROM " + self.contact_table_name + " left join " + self.address_table_name + " on " +
+                self.contact_table_name + ".contact_id = " + self.address_table_name + ".contact_id where " + where +
+                " ORDER BY " + self.address_table_name + ".address_id")
+
+    def get_many(self, contact_ids):
+        """Return (found, missing) for a list of ids, cached contacts are reused and the rest read in one query"""
+        keys, missing = self.batch_keys(contact_ids)
+        found = self.cached_many(keys)
+        wanted = [key for key in keys if key not in found]
+        if len(wanted) > 0:
+            generations = {key: self.generation(key) for key in wanted}
+            with self.connection() as conn:
+                with conn.cursor(row_factory=dict_row) as cur:
+                    cur.execute(self.select_contacts_sql(self.contact_table_name + ".contact_id = ANY(%s)"), (wanted,))
+                    with Span("fetch"):
+                        rows = cur.fetchall()
+            found.update(self.store_many(rows, generations))
+        return self.batch_result(keys, missing, found)
+
+    def batch_keys(self, contact_ids):
+        keys = []
+        missing = []
+        for contact_id in contact_ids:
+            key = self.cache_key(contact_id)
+            if key is None:
+                missing.append(contact_id)
+            elif key not in keys:
+                keys.append(key)
+        if len(keys) > self.MAX_BATCH_SIZE:
+            api.abort(400, "At most {} contacts can be fetched at once".format(self.MAX_BATCH_SIZE))
+        return keys, missing
+
+    def cached_many(self, keys):
+        found = {}
+        for key in keys:
+            entry = self.cached(key)
+            if entry is not None:
+                found[key] = entry[1]
+        return found
+
+    def store_many(self, contacts, generations):
+        with Span("transform"):
+            loaded = self.parse_db_contacts(contacts)
+            cache = self.get_cache()
+            if cache is not None:
+                for key, c1 in loaded.items():
+                    cache.set(key, (self.etag(c1), c1), generations.get(key))
+        return loaded
+
+    @staticmethod
+    def batch_result(keys, missing, found):
+        missing = missing + [key for key in keys if key not in found]
+        return [found[key] for key in keys if key in found], missing
+
+    def parse_db_contacts(self, contacts):
+        # split joined rows into one contact per contact_id, rows do not need to be ordered
+        grouped = {}
         for c in contacts:
+            c1 = grouped.get(c.get("contact_id"))
+            if c1 is None:
+                c1 = {"birth_date": c.get("birth_date", None),
+                      "first_name": c.get("first_name", None),
+                      "last_name": c.get("last_name", None),
+                      "middle_name": c.get("middle_name", None),
+                      "contact_id": c.get("contact_id", None), "addresses": []}
+                grouped[c1["contact_id"]] = c1
             if c.get("add_contact_id") is not None:
                 a = {"address_id": c.get("address_id", None), "country": c.get("country", None),
                      "title": c.get("title", None), "postal_code": c.get("postal_code", None),
@@ -201,140 +1225,514 @@ class ContactDAO(object):
                      "city": c.get("city", None), "street1": c.get("street1", None),
                      "street2": c.get("street2", None), "email": c.get("email", None),
                      "contact_id": c.get("add_contact_id", None)}
-                addresses.append(a)
-        c1 = {"birth_date": contacts[0].get("birth_date", None),
-              "first_name": contacts[0].get("first_name", None),
-              "last_name": contacts[0].get("last_name", None),
-              "middle_name": contacts[0].get("middle_name", None),
-              "contact_id": contacts[0].get("contact_id", None), "addresses": addresses}
-        return c1
+                c1["addresses"].append(a)
+        return grouped
+
+    def parse_db_contact(self, contacts):
+        return next(iter(self.parse_db_contacts(contacts).values()))
 
     def create(self, data):
-        with psycopg.connect("user=" + self.DB_USER + " password=" + self.DB_PASS + " host=" + self.DB_HOST) as conn:
+        with self.connection() as conn:
             with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute(
-                    "INSERT INTO " + self.contact_table_name + " (birth_date, first_name, last_name, middle_name) VALUES (%s, %s, %s, %s) "
-                                                               "RETURNING  birth_date, first_name, last_name, middle_name, contact_id",
-                    (data.get("birth_date",None), data.get("first_name",None), data.get("last_name",None), data.get("middle_name",None)))
+                cur.execute(self.insert_contact_sql(), self.contact_values(data))
                 new_contact = cur.fetchone()
                 addresses = data.get("addresses",None)
                 if addresses is not None and addresses.__class__ == list and len(addresses) > 0:
                     new_addresses: list = []
                     for add in addresses:
-                        cur.execute(
-                            "INSERT INTO " + self.address_table_name + " ( contact_id, country, title, postal_code, phone, province, city, street1, street2, email) "
-                                                                       "VALUES ( %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) "
-                                                                       "RETURNING address_id, contact_id, country, title, postal_code, phone, province, city, street1, street2, email",
-                            (new_contact.get("contact_id"),
-                             add.get("country",None),
-                             add.get("title",None),
-                             add.get("postal_code",None),
-                             add.get("phone",None),
-                             add.get("province",None),
-                             add.get("city",None),
-                             add.get("street1",None),
-                             add.get("street2",None),
-                             add.get("email",None))
-                        )
+                        cur.execute(self.insert_address_sql(), self.address_values(new_contact.get("contact_id"), add))
                         new_addresses.append(cur.fetchone())
                     new_contact["addresses"] = new_addresses
                 conn.commit()
+                self.invalidate(new_contact.get("contact_id"))
                 return new_contact
 
-    def update(self, contact_id, data):
-        with psycopg.connect("user=" + self.DB_USER + " password=" + self.DB_PASS + " host=" + self.DB_HOST) as conn:
+    def insert_contact_sql(self):
+        return ("INSERT INTO " + self.contact_table_name + " (birth_date, first_name, last_name, middle_name) VALUES (%s, %s, %s, %s) "
+                                                           "RETURNING  birth_date, first_name, last_name, middle_name, contact_id")
+
+    def insert_address_sql(self):
+        return ("INSERT INTO " + self.address_table_name + " ( contact_id, country, title, postal_code, phone, province, city, street1, street2, email) "
+                                                           "VALUES ( %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) "
+                                                           "RETURNING address_id, contact_id, country, title, postal_code, phone, province, city, street1, street2, email")
+
+    @staticmethod
+    def contact_values(data):
+        return (data.get("birth_date",None), data.get("first_name",None), data.get("last_name",None), data.get("middle_name",None))
+
+    @staticmethod
+    def address_values(contact_id, add):
+        return (contact_id,
+                add.get("country",None),
+                add.get("title",None),
+                add.get("postal_code",None),
+                add.get("phone",None),
+                add.get("province",None),
+                add.get("city",None),
+                add.get("street1",None),
+                add.get("street2",None),
+                add.get("email",None))
+
+    def update(self, contact_id, data, partial=False):
+        """Apply a PUT (or PATCH when partial) payload in a single statement and return the stored contact
+
+        Fields missing from the payload keep their stored value. Addresses with an address_id are updated,
+        the others are added. A PUT without addresses removes them all, a PATCH leaves them alone.
+        """
+        key = self.contact_key(contact_id)
+        sql, params = self.update_query(key, data, partial)
+        with self.connection() as conn:
             with conn.cursor(row_factory=dict_row) as cur:
-                # update existing record, default to values from the database
-                cur.execute("SELECT birth_date, first_name, last_name, middle_name FROM " + self.contact_table_name +
-                            " WHERE contact_id=%s", (contact_id,))
-                c = cur.fetchone()
-                cur.execute(
-                    "UPDATE " + self.contact_table_name + " SET birth_date=%s, first_name=%s, last_name=%s, middle_name=%s WHERE contact_id=%s "
-                                                          "RETURNING birth_date, first_name, last_name, middle_name, contact_id",
-                    (data.get("birth_date", c.get("birth_date",None)),
-                     data.get("first_name", c.get("first_name",None)),
-                     data.get("last_name", c.get("last_name", None)),
-                     data.get("middle_name", c.get("middle_name", None)),
-                     contact_id))
-                updated_contact = cur.fetchone()
-                addresses = data.get("addresses", None)
-                if addresses is not None and addresses.__class__ == list and len(addresses) > 0:
-                    updated_addresses: list = []
-                    for add in addresses:
-                        if add.get("address_id") is None or add.get("address_id") < 1:
-                            # add new address for existing contact
-                            cur.execute(
-                                "INSERT INTO " + self.address_table_name + " (contact_id, country, title, postal_code, phone, province, city, street1, street2, email)"
-                                                                           " VALUES ( %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                                (updated_contact.get("contact_id"),
-                                 add.get("country", None),
-                                 add.get("title", None),
-                                 add.get("postal_code", None),
-                                 add.get("phone", None),
-                                 add.get("province", None),
-                                 add.get("city", None),
-                                 add.get("street1", None),
-                                 add.get("street2", None),
-                                 add.get("email", None))
-                            )
-                        else:
-                            # update existing record, default to values from the database
-                            cur.execute("SELECT address_id, country, title, postal_code, phone, province, city, street1, street2, email, contact_id FROM " +
-                                        self.address_table_name + " WHERE address_id=%s AND contact_id=%s", (add.get("address_id"), contact_id))
-                            a = cur.fetchone()
-                            cur.execute("UPDATE " + self.address_table_name + " SET country=%s, title=%s, "
-                                                                              "postal_code=%s, p"
-                                                                              "hone=%s, "
-                                                                              "province=%s, "
-                                                                              "city=%s, "
-                                                                              "street1=%s, "
-                                                                              "street2=%s, "
-                                                                              "email=%s "
-                                                                              "WHERE address_id=%s",
-                                        (add.get("country",a.get("country",None)),
-                                        add.get("title", a.get("title", None)),
-                                        add.get("postal_code", a.get("postal_code", None)),
-                                        add.get("phone", a.get("phone", None)),
-                                        add.get("province", a.get("province", None)),
-                                        add.get("city", a.get("city", None)),
-                                        add.get("street1", a.get("street1", None)),
-                                        add.get("street2", a.get("street2", None)),
-                                        add.get("email", a.get("email", None)),
-                                        a.get("address_id"))
-                                        )
-                    cur.execute(
-                        "SELECT address_id, country, title, postal_code, phone, province, city, street1, street2, email, contact_id FROM " +
-                        self.address_table_name + " WHERE contact_id=%s", (contact_id,))
-                    updated_contact["addresses"] = cur.fetchall()
-                else:
-                    # remove addresses for contact
-                    cur.execute("DELETE FROM " + self.address_table_name + " WHERE contact_id=%s", (contact_id,))
-                    updated_contact["addresses"] = []
+                cur.execute(sql, params)
+                rows = cur.fetchall()
                 conn.commit()
-                return updated_contact
+        if len(rows) == 0:
+            api.abort(404, "Contact {} doesn't exist".format(contact_id))
+        self.invalidate(key)
+        return self.parse_db_contact(rows)
+
+    def update_query(self, key, data, partial):
+        data = data or {}
+        addresses = data.get("addresses", None)
+        if addresses is not None and not isinstance(addresses, list):
+            api.abort(400, "addresses must be a list")
+        addresses = [add for add in addresses or [] if isinstance(add, dict)]
+        changes = []
+        additions = []
+        for add in addresses:
+            if isinstance(add.get("address_id"), int) and add.get("address_id") > 0:
+                changes.append(add)
+            else:
+                additions.append(add)
+        replace = not partial and len(addresses) == 0
+
+        contact_sets = ", ".join(
+            name + " = CASE WHEN %(contact)s::jsonb ? '" + name + "' THEN (%(contact)s::jsonb ->> '" + name + "')" +
+            ("::date" if name == "birth_date" else "") + " ELSE " + name + " END"
+            for name in self.CONTACT_COLUMNS)
+        address_sets = ", ".join(
+            name + " = CASE WHEN v.doc ? '" + name + "' THEN v.doc ->> '" + name + "' ELSE a." + name + " END"
+            for name in self.ADDRESS_COLUMNS)
+        address_columns = "address_id, contact_id, " + ", ".join(self.ADDRESS_COLUMNS)
+        sql = ("WITH c AS (UPDATE " + self.contact_table_name + " SET " + contact_sets +
+               " WHERE contact_id = %(contact_id)s RETURNING birth_date, first_name, last_name, middle_name, contact_id), " +
+               # a PUT without addresses clears them
+               "d AS (DELETE FROM " + self.address_table_name + " WHERE %(replace)s AND contact_id = (SELECT contact_id FROM c)), " +
+               "u AS (UPDATE " + self.address_table_name + " a SET " + address_sets +
+               " FROM jsonb_array_elements(%(changes)s::jsonb) v(doc)" +
+               " WHERE a.contact_id = (SELECT contact_id FROM c) AND a.address_id = (v.doc ->> 'address_id')::int" +
+               " RETURNING a." + address_columns.replace(", ", ", a.") + "), " +
+               "i AS (INSERT INTO " + self.address_table_name + " (contact_id, " + ", ".join(self.ADDRESS_COLUMNS) + ")" +
+               " SELECT c.contact_id, " + ", ".join("v.doc ->> '" + name + "'" for name in self.ADDRESS_COLUMNS) +
+               " FROM c, jsonb_array_elements(%(additions)s::jsonb) v(doc)" +
+               " RETURNING " + address_columns + "), " +
+               # statements in a WITH share one snapshot, so the final state is the untouched rows plus u and i
+               "a AS (SELECT " + address_columns + " FROM " + self.address_table_name +
+               " WHERE NOT %(replace)s AND contact_id = (SELECT contact_id FROM c)" +
+               " AND address_id NOT IN (SELECT address_id FROM u)" +
+               " UNION ALL SELECT * FROM u UNION ALL SELECT * FROM i) " +
+               "SELECT c.birth_date, c.first_name, c.last_name, c.middle_name, c.contact_id, " +
+               "a.contact_id AS add_contact_id, " + ", ".join("a." + name for name in ["address_id"] + list(self.ADDRESS_COLUMNS)) +
+               " FROM c LEFT JOIN a ON true ORDER BY a.address_id")
+        params = {"contact_id": key,
+                  "contact": Jsonb({name: data[name] for name in self.CONTACT_COLUMNS if name in data}),
+                  "changes": Jsonb(changes),
+                  "additions": Jsonb(additions),
+                  "replace": replace}
+        return sql, params
 
     def delete(self, contact_id):
-        with psycopg.connect("user=" + self.DB_USER + " password=" + self.DB_PASS + " host=" + self.DB_HOST) as conn:
-            with conn.cursor(row_factory=dict_row) as cur:
-                cur.execute("DELETE FROM " + self.contact_table_name +
-                            " WHERE contact_id=%s", (contact_id,))
-                cur.execute(
-                    "SELECT contact_id FROM " + self.address_table_name + " WHERE contact_id = %s", (contact_id,))
-                ad = cur.fetchone()
-                if ad is not None and len(ad) > 0:
-                    cur.execute("DELETE FROM " + self.address_table_name + " WHERE contact_id=%s", (contact_id,))
+        key = self.cache_key(contact_id)
+        if key is None:
+            return
+        with self.connection() as conn:
+            # addresses go with the contact through the ON DELETE CASCADE foreign key
+            conn.execute("DELETE FROM " + self.contact_table_name + " WHERE contact_id=%s", (key,))
+        self.invalidate(key)
+
+    def validate_import(self, data):
+        # catch the common bad rows before they reach COPY and fail the whole batch
+        if not isinstance(data, dict):
+            return "Contact must be an object"
+        addresses = data.get("addresses", None)
+        if addresses is not None and not isinstance(addresses, list):
+            return "addresses must be a list"
+        checks = [(data, self.CONTACT_COLUMNS, "")]
+        for i, add in enumerate(addresses or []):
+            if not isinstance(add, dict):
+                return "addresses[{}] must be an object".format(i)
+            checks.append((add, self.ADDRESS_COLUMNS, "addresses[{}].".format(i)))
+        for record, columns, prefix in checks:
+            for name, size in columns.items():
+                value = record.get(name, None)
+                if value is None:
+                    continue
+                if name == "birth_date":
+                    try:
+                        date.fromisoformat(value)
+                    except (TypeError, ValueError):
+                        return "{}birth_date must be an ISO date".format(prefix)
+                elif not isinstance(value, str):
+                    return "{}{} must be a string".format(prefix, name)
+                elif len(value) > size:
+                    return "{}{} is longer than {} characters".format(prefix, name, size)
+        return None
+
+    def bulk_import(self, records, batch_size=None):
+        """Load (row, data, error) tuples in batches, yielding one result per row and a progress entry per batch"""
+        batch_size = batch_size or self.IMPORT_BATCH_SIZE
+        imported = 0
+        failed = 0
+        rows = 0
+        with self.connection() as conn:
+            batch = []
+            for row, data, error in itertools.chain(records, [(None, None, None)]):
+                if row is not None:
+                    rows += 1
+                    error = error or self.validate_import(data)
+                    if error is not None:
+                        failed += 1
+                        yield {"row": row, "error": error}
+                    else:
+                        batch.append((row, data))
+                if len(batch) >= batch_size or (row is None and len(batch) > 0):
+                    for result in self.import_batch(conn, batch):
+                        if "error" in result:
+                            failed += 1
+                        else:
+                            imported += 1
+                        yield result
+                    batch = []
+                    yield {"progress": {"rows": rows, "imported": imported, "failed": failed}}
+        yield {"summary": {"rows": rows, "imported": imported, "failed": failed}}
+
+    def import_batch(self, conn, batch):
+        address_count = sum(len(data.get("addresses", None) or []) for row, data in batch)
+        with conn.cursor() as cur:
+            # reserve the keys up front so COPY can write them and the caller gets the mapping back
+            cur.execute("SELECT nextval(pg_get_serial_sequence(%s, 'contact_id')) FROM generate_series(1, %s)",
+                        (self.contact_table_name, len(batch)))
+            contact_ids = [r[0] for r in cur.fetchall()]
+            cur.execute("SELECT nextval(pg_get_serial_sequence(%s, 'address_id')) FROM generate_series(1, %s)",
+                        (self.address_table_name, address_count))
+            address_ids = iter([r[0] for r in cur.fetchall()])
+        conn.commit()
+
+        results = []
+        contact_rows = []
+        address_rows = []
+        for (row, data), contact_id in zip(batch, contact_ids):
+            contact_rows.append((contact_id,) + tuple(data.get(name, None) for name in self.CONTACT_COLUMNS))
+            new_address_ids = []
+            for add in data.get("addresses", None) or []:
+                address_id = next(address_ids)
+                new_address_ids.append(address_id)
+                address_rows.append((address_id, contact_id) + tuple(add.get(name, None) for name in self.ADDRESS_COLUMNS))
+            results.append({"row": row, "contact_id": contact_id, "address_ids": new_address_ids})
+
+        contact_copy = ("COPY " + self.contact_table_name + " (contact_id, " + ", ".join(self.CONTACT_COLUMNS) +
+                        ") FROM STDIN")
+        address_copy = ("COPY " + self.address_table_name + " (address_id, contact_id, " + ", ".join(self.ADDRESS_COLUMNS) +
+                        ") FROM STDIN")
+        try:
+            with conn.transaction():
+                with conn.cursor() as cur:
+                    with cur.copy(contact_copy) as copy:
+                        for r in contact_rows:
+                            copy.write_row(r)
+                    with cur.copy(address_copy) as copy:
+                        for r in address_rows:
+                            copy.write_row(r)
+            return results
+        except psycopg.DataError:
+            pass
+
+        # the batch was rejected, load it again row by row to find the offending rows
+        contact_insert = ("INSERT INTO " + self.contact_table_name + " (contact_id, " + ", ".join(self.CONTACT_COLUMNS) +
+                          ") VALUES (%s" + ", %s" * len(self.CONTACT_COLUMNS) + ")")
+        address_insert = ("INSERT INTO " + self.address_table_name + " (address_id, contact_id, " +
+                          ", ".join(self.ADDRESS_COLUMNS) + ") VALUES (%s, %s" + ", %s" * len(self.ADDRESS_COLUMNS) + ")")
+        address_rows = iter(address_rows)
+        for i, result in enumerate(results):
+            rows_for_contact = [next(address_rows) for _ in result["address_ids"]]
+            try:
+                with conn.transaction():
+                    with conn.cursor() as cur:
+                        cur.execute(contact_insert, contact_rows[i])
+                        cur.executemany(address_insert, rows_for_contact)
+            except psycopg.DataError as e:
+                results[i] = {"row": result["row"], "error": str(e).strip()}
+        return results
+
+    def export_query(self, fmt, updated_since=None):
+        """COPY statement writing every contact, or those changed since updated_since, ordered by contact_id"""
+        where = ""
+        params = []
+        if updated_since is not None:
+            where = " WHERE c.updated_at >= %s"
+            params.append(updated_since)
+        if fmt == "csv":
+            # one line per address, ref lets the CSV import read the file back
+            select = ("SELECT c.contact_id AS ref, c.contact_id, c.updated_at, " +
+                      ", ".join("c." + name for name in self.CONTACT_COLUMNS) + ", a.address_id, " +
+                      ", ".join("a." + name for name in self.ADDRESS_COLUMNS) + ", a.updated_at AS address_updated_at" +
+                      " FROM " + self.contact_table_name + " c LEFT JOIN " + self.address_table_name +
+                      " a ON a.contact_id = c.contact_id" + where + " ORDER BY c.contact_id, a.address_id")
+            return "COPY (" + select + ") TO STDOUT WITH (FORMAT csv, HEADER)", params
+        select = ("SELECT " + self.document_expression("c", ("birth_date", "updated_at")) + " FROM " +
+                  self.contact_table_name + " c" + where + " ORDER BY c.contact_id")
+        # JSON text holds no raw control characters, with these as quote and delimiter every line is written as is
+        return "COPY (" + select + ") TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')", params
+
+    def export(self, fmt, updated_since=None):
+        """Yield the contacts as NDJSON or flattened CSV, in chunks of about EXPORT_CHUNK_SIZE bytes"""
+        sql, params = self.export_query(fmt, updated_since)
+        return self.copy_out(sql, params)
+
+    def copy_out(self, sql, params):
+        with self.connection() as conn:
+            with conn.cursor() as cur:
+                with cur.copy(sql, params) as copy:
+                    buffer = bytearray()
+                    for data in copy:
+                        buffer += data
+                        if len(buffer) >= self.EXPORT_CHUNK_SIZE:
+                            yield bytes(buffer)
+                            buffer.clear()
+                    if len(buffer) > 0:
+                        yield bytes(buffer)
+
+
+def read_json_array(stream, chunk_size=1 << 16, max_element_size=1 << 20):
+    """Yield (row, data, error) for each element of a JSON array, reading the stream a chunk at a time
+
+    An element is only accepted once more input follows it, a number at the end of the buffer may be cut in two.
+    Elements that do not parse within ``max_element_size`` characters fail the import instead of buffering the body.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    row = 0
+    expect = "["
+    eof = False
+    while True:
+        while pos < len(buffer) and buffer[pos].isspace():
+            pos += 1
+        if pos < len(buffer):
+            ch = buffer[pos]
+            if expect == "[":
+                if ch != "[":
+                    yield row + 1, None, "Expected a JSON array"
+                    return
+                pos += 1
+                expect = "first"
+                continue
+            if ch == "]" and expect in ("first", ","):
+                return
+            if expect == ",":
+                if ch != ",":
+                    yield row + 1, None, "Invalid JSON"
+                    return
+                pos += 1
+                expect = "value"
+                continue
+            try:
+                data, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # the element may be cut off at the end of the buffer, read more before giving up
+                end = None
+            if end is not None and (end < len(buffer) or eof):
+                row += 1
+                pos = end
+                expect = ","
+                yield row, data, None
+                continue
+            if eof:
+                yield row + 1, None, "Invalid JSON"
+                return
+            if len(buffer) - pos > max_element_size:
+                yield row + 1, None, "Invalid JSON or element longer than {} characters".format(max_element_size)
+                return
+        elif eof:
+            yield row + 1, None, "Unexpected end of JSON array"
+            return
+        chunk = stream.read(chunk_size)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+
+def read_ndjson(stream):
+    """Yield (row, data, error) for each line of an NDJSON stream"""
+    for row, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield row, json.loads(line), None
+        except ValueError:
+            yield row, None, "Invalid JSON"
+
+
+def read_csv(stream):
+    """Yield (row, data, error) from a flattened CSV, one address per line
+
+    Consecutive lines with the same non empty ``ref`` column are addresses of the same contact.
+    """
+    current = None
+    current_ref = None
+    start = None
+    for row, line in enumerate(csv.DictReader(stream), start=1):
+        ref = line.get("ref") or None
+        if current is None or ref is None or ref != current_ref:
+            if current is not None:
+                yield start, current, None
+            current = {name: line.get(name) or None for name in ContactDAO.CONTACT_COLUMNS}
+            current["addresses"] = []
+            current_ref = ref
+            start = row
+        add = {name: line.get(name) or None for name in ContactDAO.ADDRESS_COLUMNS}
+        if any(value is not None for value in add.values()):
+            current["addresses"].append(add)
+    if current is not None:
+        yield start, current, None
+
+
+IMPORT_READERS = {"json": read_json_array, "ndjson": read_ndjson, "csv": read_csv}
+IMPORT_MIMETYPES = {"application/json": "json", "application/x-ndjson": "ndjson", "text/csv": "csv"}
+
+
+def read_import(stream, fmt):
+    """Yield (row, data, error) from the reader of the format, a body that is not UTF-8 fails at the row it breaks"""
+    row = 0
+    try:
+        for row, data, error in IMPORT_READERS[fmt](stream):
+            yield row, data, error
+    except UnicodeDecodeError:
+        yield row + 1, None, "Invalid UTF-8"
+
+
+import_parser = reqparse.RequestParser()
+import_parser.add_argument('format', type=str, choices=tuple(IMPORT_READERS), help='Body format, defaults to the Content-Type',
+                           location='args')
+import_parser.add_argument('batch_size', type=int, help='Contacts loaded per COPY batch', location='args')
+
+
+list_parser = reqparse.RequestParser()
+list_parser.add_argument('field', type=str, help='Order By Field', location='args')
+list_parser.add_argument('direction', type=str, help='Order By Direction', location='args')
+list_parser.add_argument('limit', type=int, help='Page size', location='args')
+list_parser.add_argument('after', type=str, help='Cursor returned in X-Next-Cursor by the previous page', location='args')
+list_parser.add_argument('stream', type=str, choices=("json", "ndjson"), help='Stream the listing as a JSON array or NDJSON',
+                         location='args')
+
+
+def stream_contacts(contacts, fmt, mask=None):
+    """Serialize contacts one at a time as a JSON array or as NDJSON"""
+    if fmt == "ndjson":
+        for c in contacts:
+            yield json.dumps(marshal(c, contact, mask=mask)) + "\n"
+        return
+    yield "["
+    separator = ""
+    for c in contacts:
+        yield separator + json.dumps(marshal(c, contact, mask=mask))
+        separator = ","
+    yield "]"
+
+
+# compiled serializers for the listings, addresses are read from the raw rows of ContactRecord
+address_json = JsonSerializer(address, {name: itemgetter(ContactDAO.ROW_COLUMNS.index("add_contact_id" if name == "contact_id" else name))
+                                        for name in address})
+contact_json = JsonSerializer(contact, {name: attrgetter(name) for name in contact}, {"addresses": address_json})
+
+
+def fast_json():
+    # the compiled serializers reproduce restx's default JSON, not the indented debug output or custom RESTX_JSON
+    return (current_app.config.get("CONTACT_FAST_JSON", True) and not current_app.debug and
+            not current_app.config.get("RESTX_JSON"))
+
+
+def stream_documents(documents, fmt):
+    """Write contact JSON texts as they come as a JSON array or as NDJSON"""
+    if fmt == "ndjson":
+        for document in documents:
+            yield document + "\n"
+        return
+    yield "["
+    separator = ""
+    for document in documents:
+        yield separator + document
+        separator = ", "
+    yield "]"
+
+
+def field_mask():
+    """The X-Fields mask of the request, as marshal_with applies it"""
+    return request.headers.get(current_app.config["RESTX_MASK_HEADER"])
+
+
+def peek_stream(dao, items, after, filters=None):
+    """Read the first streamed item before answering, so an empty stream fails the same way as an empty page"""
+    first = next(items, None)
+    if first is None:
+        items.close()
+        dao.check_listing(0, after, filters)
+        return iter(())
+    return itertools.chain([first], items)
+
+
+def listing_response(dao, args, filters=None):
+    """Answer a listing or search request, streamed, compiled, marshalled or built by Postgres"""
+    # a field mask needs marshal, documents and compiled serializers always write every field
+    mask = field_mask()
+    if args["stream"] is not None:
+        mimetype = "application/x-ndjson" if args["stream"] == "ndjson" else "application/json"
+        if dao.DOCUMENTS != "off" and mask is None:
+            documents = dao.iter_documents(args["field"], args["direction"], args["limit"], args["after"], filters)
+            documents = peek_stream(dao, documents, args["after"], filters)
+            return Response(stream_documents(documents, args["stream"]), mimetype=mimetype)
+        contacts = dao.iter_all(args["field"], args["direction"], args["limit"], args["after"], filters)
+        contacts = peek_stream(dao, contacts, args["after"], filters)
+        return Response(stream_contacts(contacts, args["stream"], mask), mimetype=mimetype)
+
+    if dao.DOCUMENTS != "off" and mask is None:
+        documents, next_cursor = dao.get_all_documents(args["field"], args["direction"], args["limit"], args["after"],
+                                                       filters)
+        headers = {} if next_cursor is None else {"X-Next-Cursor": next_cursor}
+        return Response("[" + ", ".join(documents) + "]\n", 200, headers, mimetype="application/json")
+
+    if fast_json() and mask is None:
+        listing, next_cursor = dao.get_all_records(args["field"], args["direction"], args["limit"], args["after"],
+                                                           filters)
+        headers = {} if next_cursor is None else {"X-Next-Cursor": next_cursor}
+        with Span("marshal"):
+            body = contact_json.dumps_list(listing) + "\n"
+        return Response(body, 200, headers, mimetype="application/json")
+
+    listing, next_cursor = dao.get_all(args["field"], args["direction"], args["limit"], args["after"], filters)
+    headers = {} if next_cursor is None else {"X-Next-Cursor": next_cursor}
+    with Span("marshal"):
+        body = marshal(listing, contact, mask=mask)
+    return body, 200, headers
+
+
+contact_dao = ContactDAO()
+
 
 @ns.route("/")
 class ContactList(Resource):
 
-    contact_dao = ContactDAO()
+    contact_dao = contact_dao
     """Shows a list of all contacts, and lets you POST to add new contacts"""
 
     @ns.doc("list_contacts")
-    @ns.marshal_list_with(contact)
+    @ns.expect(list_parser)
+    @ns.response(200, "Success", [contact])
     def get(self):
         """List all contacts"""
-        return self.contact_dao.get_all()
+        return listing_response(self.contact_dao, list_parser.parse_args())
+
     @ns.doc("create_contact")
     @ns.expect(contact)
     @ns.marshal_with(contact, code=201)
@@ -342,19 +1740,139 @@ class ContactList(Resource):
         """Create a new contact"""
         return self.contact_dao.create(api.payload), 201
 
+@ns.route("/import")
+class ContactImport(Resource):
+    contact_dao = contact_dao
+
+    """Bulk loads contacts from a JSON array, NDJSON or CSV body"""
+
+    @ns.doc("import_contacts")
+    @ns.expect(import_parser)
+    def post(self):
+        """Import contacts, answers with one NDJSON line per row plus progress and summary lines"""
+        args = import_parser.parse_args()
+        if args["batch_size"] is not None and args["batch_size"] < 1:
+            api.abort(400, "batch_size must be positive")
+        fmt = args["format"] or IMPORT_MIMETYPES.get(request.mimetype, "json")
+        stream = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+        results = self.contact_dao.bulk_import(read_import(stream, fmt), args["batch_size"])
+        return Response(stream_with_context(json.dumps(r) + "\n" for r in results), mimetype="application/x-ndjson")
+
+
+EXPORT_MIMETYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+export_parser = reqparse.RequestParser()
+export_parser.add_argument('format', type=str, choices=tuple(EXPORT_MIMETYPES), default='ndjson',
+                           help='NDJSON with nested addresses, or CSV with one line per address', location='args')
+export_parser.add_argument('updated_since', type=inputs.datetime_from_iso8601,
+                           help='Only contacts changed at or after this ISO 8601 time', location='args')
+
+
+def gzip_stream(chunks, level=6):
+    """Compress a stream of byte chunks as it is written"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if len(data) > 0:
+            yield data
+    yield compressor.flush()
+
+
+@ns.route("/export")
+class ContactExport(Resource):
+    contact_dao = contact_dao
+
+    """Streams every contact for bulk synchronization"""
+
+    @ns.doc("export_contacts")
+    @ns.expect(export_parser)
+    def get(self):
+        """Export contacts through COPY, chunked and gzipped when the client accepts it"""
+        args = export_parser.parse_args()
+        chunks = self.contact_dao.export(args["format"], args["updated_since"])
+        headers = {"Vary": "Accept-Encoding"}
+        if request.accept_encodings["gzip"]:
+            chunks = gzip_stream(chunks)
+            headers["Content-Encoding"] = "gzip"
+        return Response(chunks, 200, headers, mimetype=EXPORT_MIMETYPES[args["format"]])
+
+
+batch_parser = reqparse.RequestParser()
+batch_parser.add_argument('ids', type=str, action='split', required=True, help='Comma separated contact identifiers',
+                          location='args')
+
+
+@ns.route("/batch")
+class ContactBatch(Resource):
+    contact_dao = contact_dao
+
+    """Fetches many contacts in one call"""
+
+    @ns.doc("get_contacts")
+    @ns.expect(batch_parser)
+    @ns.marshal_with(contact_batch)
+    def get(self):
+        """Fetch the given contacts, ids that do not exist are listed under missing"""
+        args = batch_parser.parse_args()
+        found, missing = self.contact_dao.get_many(args["ids"])
+        return {"contacts": found, "missing": missing}
+
+
+search_parser = list_parser.copy()
+search_parser.add_argument('name', type=str, help='Words prefixing the first, middle or last name', location='args')
+search_parser.add_argument('email', type=str, help='Exact address email', location='args')
+search_parser.add_argument('city', type=str, help='Address city', location='args')
+search_parser.add_argument('province', type=str, help='Address province', location='args')
+search_parser.add_argument('postal_code', type=str, help='Address postal code', location='args')
+
+
+@ns.route("/search")
+class ContactSearch(Resource):
+    contact_dao = contact_dao
+
+    """Finds contacts by name and address"""
+
+    @ns.doc("search_contacts")
+    @ns.expect(search_parser)
+    @ns.response(200, "Success", [contact])
+    def get(self):
+        """Search contacts, takes the same ordering, paging and streaming arguments as the listing"""
+        args = search_parser.parse_args()
+        filters = self.contact_dao.search_filters(args["name"], args["email"], args["city"], args["province"],
+                                                  args["postal_code"])
+        if len(filters) == 0:
+            api.abort(400, "Give at least one of name, email, city, province or postal_code")
+        return listing_response(self.contact_dao, args, filters)
+
+
 @ns.route("/<string:contact_id>")
 @ns.response(404, "Contact not found")
 @ns.param("contact_id", "The contact identifier")
 class Contact(Resource):
-    contact_dao = ContactDAO()
+    contact_dao = contact_dao
 
     """Show a single contact item and lets you delete them"""
 
     @ns.doc("get_contact")
-    @ns.marshal_with(contact)
+    @ns.response(200, "Success", contact)
+    @ns.response(304, "Contact not modified")
     def get(self, contact_id):
         """Fetch a given resource"""
-        return self.contact_dao.get(contact_id)
+        mask = field_mask()
+        documents = self.contact_dao.DOCUMENTS != "off" and mask is None
+        if documents:
+            etag, found = self.contact_dao.get_document(contact_id)
+        else:
+            etag, found = self.contact_dao.get_versioned(contact_id)
+        etag = self.contact_dao.masked_etag(etag, mask)
+        headers = {"ETag": quote_etag(etag), "Vary": current_app.config["RESTX_MASK_HEADER"]}
+        if request.if_none_match.contains_weak(etag):
+            return "", 304, headers
+        if documents:
+            return Response(found + "\n", 200, headers, mimetype="application/json")
+        with Span("marshal"):
+            body = marshal(found, contact, mask=mask)
+        return body, 200, headers
 
     @ns.doc("delete_contacts")
     @ns.response(204, "Contact deleted")
@@ -368,7 +1886,167 @@ class Contact(Resource):
         """Update a contact given its identifier"""
         return self.contact_dao.update(contact_id, api.payload)
 
+    @ns.expect(contact)
+    @ns.marshal_with(contact)
+    def patch(self, contact_id):
+        """Update the given fields of a contact, addresses left out of the payload are kept"""
+        return self.contact_dao.update(contact_id, api.payload, partial=True)
+
+
+@app.before_request
+def start_instrumentation():
+    endpoint = request.endpoint or "unmatched"
+    request_timings.set(RequestTimings(endpoint) if ContactDAO.INSTRUMENT else None)
+    if ContactDAO.PROFILE_RATE > 0:
+        g.contact_profile = ContactDAO.get_profiler().start()
+
+
+@app.after_request
+def finish_instrumentation(response):
+    # streamed bodies are written after this point, their timings stop at the headers
+    endpoint = request.endpoint or "unmatched"
+    timings = request_timings.get()
+    if timings is not None:
+        total = timings.total()
+        response.headers["Server-Timing"] = timings.server_timing(total)
+        ContactDAO.get_metrics().observe_request(endpoint, request.method, response.status_code, total, timings)
+    return response
+
+
+@app.teardown_request
+def clear_instrumentation(exc):
+    # runs even when the view raised and after_request was skipped, so the profiler is always released
+    profile = g.pop("contact_profile", None)
+    if profile is not None:
+        ContactDAO.get_profiler().stop(request.endpoint or "unmatched", profile)
+    request_timings.set(None)
+
+
+stats_ns = api.namespace("stats", description="STATS operations")
+
+
+@stats_ns.route("/pool")
+class PoolStats(Resource):
+    """Shows the database connection pool counters"""
+
+    @stats_ns.doc("pool_stats")
+    def get(self):
+        """Connection pool size, availability and wait time"""
+        return ContactDAO.pool_stats()
+
+
+@stats_ns.route("/cache")
+class CacheStats(Resource):
+    """Shows the contact cache counters"""
+
+    @stats_ns.doc("cache_stats")
+    def get(self):
+        """Contact cache hits, misses and evictions"""
+        return ContactDAO.cache_stats()
+
+
+@stats_ns.route("/metrics")
+class MetricsExport(Resource):
+    """Exposes the request, statement, pool and cache counters to Prometheus"""
+
+    @stats_ns.doc("metrics")
+    def get(self):
+        """Metrics in the Prometheus text format"""
+        gauges = {}
+        for name, value in ContactDAO.pool_stats().items():
+            gauges["contact_" + name if name.startswith("pool_") else "contact_pool_" + name] = value
+        for name, value in ContactDAO.cache_stats().items():
+            gauges["contact_cache_" + name] = value
+        return Response(ContactDAO.get_metrics().render(gauges), mimetype="text/plain; version=0.0.4")
+
+
+@stats_ns.route("/queries")
+class QueryStats(Resource):
+    """Shows the statements sent by the process"""
+
+    @stats_ns.doc("query_stats")
+    def get(self):
+        """Calls, total and worst time and rows of every statement, most expensive first"""
+        return ContactDAO.get_metrics().query_stats()
+
+
+profile_parser = reqparse.RequestParser()
+profile_parser.add_argument('sort', type=str, choices=("cumulative", "tottime", "calls"), default="cumulative",
+                            help='Sort order of the functions', location='args')
+profile_parser.add_argument('limit', type=int, default=40, help='Functions shown', location='args')
+
+
+@stats_ns.route("/profile")
+class ProfileList(Resource):
+    """Lists the endpoints with sampled profiles"""
+
+    @stats_ns.doc("profiled_endpoints")
+    def get(self):
+        """Sampled requests per endpoint, requires CONTACT_PROFILE_RATE"""
+        return {"rate": ContactDAO.PROFILE_RATE, "endpoints": ContactDAO.get_profiler().endpoints()}
+
+
+@stats_ns.route("/profile/<string:endpoint>")
+@stats_ns.param("endpoint", "The endpoint name, as listed by /stats/profile")
+class Profile(Resource):
+    """Shows the accumulated cProfile statistics of an endpoint"""
+
+    @stats_ns.doc("endpoint_profile")
+    @stats_ns.expect(profile_parser)
+    def get(self, endpoint):
+        """pstats report of the sampled requests"""
+        args = profile_parser.parse_args()
+        report = ContactDAO.get_profiler().report(endpoint, args["sort"], args["limit"])
+        if report is None:
+            api.abort(404, "No profile for endpoint {}".format(endpoint))
+        return Response(report, mimetype="text/plain")
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Contact API")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("serve", help="migrate the schema and run the development server (default)")
+    migrate_command = commands.add_parser("migrate", help="apply pending schema migrations")
+    migrate_command.add_argument("--drop", action="store_true", help="drop the tables and rebuild them first")
+    migrate_command.add_argument("--documents", action="store_true", default=None,
+                                 help="install the document column and triggers of CONTACT_DOCUMENTS=materialized")
+    migrate_command.add_argument("--drop-documents", action="store_false", dest="documents",
+                                 help="remove the document column and triggers")
+    import_command = commands.add_parser("import", help="bulk import contacts, prints one NDJSON line per row")
+    import_command.add_argument("file", help="JSON array, NDJSON or CSV file, - reads stdin")
+    import_command.add_argument("--format", choices=tuple(IMPORT_READERS), help="defaults to the file extension")
+    import_command.add_argument("--batch-size", type=int, help="contacts loaded per COPY batch")
+    export_command = commands.add_parser("export", help="stream every contact as NDJSON or CSV")
+    export_command.add_argument("--format", choices=tuple(EXPORT_MIMETYPES), default="ndjson")
+    export_command.add_argument("--updated-since", type=datetime.fromisoformat,
+                                help="only contacts changed at or after this ISO 8601 time")
+    export_command.add_argument("--output", default="-", help="file to write, - writes stdout, .gz compresses")
+    export_command.add_argument("--gzip", action="store_true", help="compress the output")
+    args = parser.parse_args(argv)
+
+    if args.command == "import":
+        fmt = args.format or os.path.splitext(args.file)[1].lstrip(".").lower()
+        if fmt not in IMPORT_READERS:
+            parser.error("cannot tell the format of {}, use --format".format(args.file))
+        with (sys.stdin if args.file == "-" else open(args.file, encoding="utf-8", newline="")) as f:
+            for result in contact_dao.bulk_import(read_import(f, fmt), args.batch_size):
+                print(json.dumps(result))
+    elif args.command == "export":
+        chunks = contact_dao.export(args.format, args.updated_since)
+        if args.gzip or args.output.endswith(".gz"):
+            chunks = gzip_stream(chunks)
+        with (sys.stdout.buffer if args.output == "-" else open(args.output, "wb")) as f:
+            for chunk in chunks:
+                f.write(chunk)
+    elif args.command == "migrate":
+        applied = contact_dao.migrate(drop=args.drop, documents=args.documents)
+        print("applied migrations {}, schema version {}".format(applied, contact_dao.schema_version()))
+        with contact_dao.connection() as conn:
+            print("materialized documents {}".format("installed" if contact_dao.documents_installed(conn) else "not installed"))
+    else:
+        contact_dao.migrate()
+        app.run(debug=True)
 
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    cli()
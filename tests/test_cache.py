@@ -0,0 +1,72 @@
+import time
+
+from main import LRUCache
+
+
+def test_get_set_delete():
+    cache = LRUCache(max_size=10, ttl=60)
+    assert cache.get(1) is None
+    cache.set(1, "a")
+    assert cache.get(1) == "a"
+    cache.delete(1)
+    assert cache.get(1) is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache(max_size=2, ttl=60)
+    cache.set(1, "a")
+    cache.set(2, "b")
+    cache.get(1)
+    cache.set(3, "c")
+    assert cache.get(2) is None
+    assert cache.get(1) == "a"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_expires():
+    cache = LRUCache(max_size=2, ttl=0.01)
+    cache.set(1, "a")
+    time.sleep(0.02)
+    assert cache.get(1) is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_set_after_delete_is_dropped():
+    # a reader takes the generation, a writer invalidates the key, then the reader stores what it read before
+    cache = LRUCache(max_size=10, ttl=60)
+    generation = cache.generation(1)
+    cache.delete(1)
+    cache.set(1, "stale", generation)
+    assert cache.get(1) is None
+    assert cache.stats()["stale_sets"] == 1
+    cache.set(1, "fresh", cache.generation(1))
+    assert cache.get(1) == "fresh"
+
+
+def test_set_without_delete_is_kept():
+    cache = LRUCache(max_size=10, ttl=60)
+    generation = cache.generation(1)
+    cache.delete(2)
+    cache.set(1, "a", generation)
+    assert cache.get(1) == "a"
+
+
+def test_forgotten_generations_drop_pending_sets():
+    cache = LRUCache(max_size=2, ttl=60)
+    generation = cache.generation(1)
+    cache.delete(1)
+    cache.delete(2)
+    cache.delete(3)
+    # the delete of 1 is no longer remembered, its pending set must still be dropped
+    assert 1 not in cache.generations
+    cache.set(1, "stale", generation)
+    assert cache.get(1) is None
+
+
+def test_clear_drops_pending_sets():
+    cache = LRUCache(max_size=10, ttl=60)
+    generation = cache.generation(1)
+    cache.clear()
+    cache.set(1, "stale", generation)
+    assert cache.get(1) is None
@@ -0,0 +1,129 @@
+import io
+import json
+
+import pytest
+
+from main import ContactDAO, read_csv, read_import, read_json_array, read_ndjson
+
+
+class CountingReader(io.StringIO):
+    """A text stream remembering how many characters were read from it"""
+
+    def __init__(self, text):
+        super().__init__(text)
+        self.consumed = 0
+
+    def read(self, size=-1):
+        chunk = super().read(size)
+        self.consumed += len(chunk)
+        return chunk
+
+
+CONTACTS = [
+    {"first_name": "Ada", "last_name": "Lovelace", "addresses": [{"city": "London", "postal_code": "W1"}]},
+    {"first_name": "Grace", "last_name": "Hopper", "addresses": []},
+    {"first_name": "Zoë", "last_name": "O\"Brien"},
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 7, 16, 1 << 16])
+def test_json_array_any_chunk_size(chunk_size):
+    body = json.dumps(CONTACTS, indent=1)
+    rows = list(read_json_array(io.StringIO(body), chunk_size=chunk_size))
+    assert rows == [(i, c, None) for i, c in enumerate(CONTACTS, start=1)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 5])
+def test_json_array_scalar_across_chunks(chunk_size):
+    rows = list(read_json_array(io.StringIO("[1234, 5, true, null]"), chunk_size=chunk_size))
+    assert rows == [(1, 1234, None), (2, 5, None), (3, True, None), (4, None, None)]
+
+
+@pytest.mark.parametrize("body", ["[]", " [ ] ", "[\n]\n"])
+def test_json_array_empty(body):
+    assert list(read_json_array(io.StringIO(body), chunk_size=1)) == []
+
+
+@pytest.mark.parametrize("body, rows", [
+    ("{}", [(1, None, "Expected a JSON array")]),
+    ("", [(1, None, "Unexpected end of JSON array")]),
+    ("[{}", [(1, {}, None), (2, None, "Unexpected end of JSON array")]),
+    ("[{} {}]", [(1, {}, None), (2, None, "Invalid JSON")]),
+    ("[{}, {\"a\": ]", [(1, {}, None), (2, None, "Invalid JSON")]),
+])
+def test_json_array_errors(body, rows):
+    assert list(read_json_array(io.StringIO(body), chunk_size=2)) == rows
+
+
+def test_json_array_bad_element_is_bounded():
+    # a malformed element must not make the reader buffer the rest of the body
+    body = "[{\"a\": x}, " + ", ".join(["{}"] * 200000) + "]"
+    stream = CountingReader(body)
+    rows = list(read_json_array(stream, chunk_size=1024, max_element_size=4096))
+    assert rows == [(1, None, "Invalid JSON or element longer than 4096 characters")]
+    assert stream.consumed <= 4096 + 2 * 1024
+
+
+def test_json_array_large_element_within_limit():
+    big = {"first_name": "x" * 5000}
+    rows = list(read_json_array(io.StringIO(json.dumps([big, {}])), chunk_size=256, max_element_size=8192))
+    assert rows == [(1, big, None), (2, {}, None)]
+
+
+def test_ndjson():
+    body = json.dumps(CONTACTS[0]) + "\n\n{oops\n" + json.dumps(CONTACTS[1]) + "\n"
+    assert list(read_ndjson(io.StringIO(body))) == [
+        (1, CONTACTS[0], None),
+        (3, None, "Invalid JSON"),
+        (4, CONTACTS[1], None),
+    ]
+
+
+def test_csv_groups_addresses_by_ref():
+    body = ("ref,first_name,last_name,city,postal_code\n"
+            "1,Ada,Lovelace,London,W1\n"
+            "1,Ada,Lovelace,Paris,75001\n"
+            ",Grace,Hopper,,\n"
+            ",Alan,Turing,Wilmslow,SK9\n")
+    rows = list(read_csv(io.StringIO(body, newline="")))
+    assert [(row, data["first_name"], [a["city"] for a in data["addresses"]], error) for row, data, error in rows] == [
+        (1, "Ada", ["London", "Paris"], None),
+        (3, "Grace", [], None),
+        (4, "Alan", ["Wilmslow"], None),
+    ]
+    assert rows[0][1]["middle_name"] is None
+
+
+@pytest.mark.parametrize("fmt", ["json", "ndjson", "csv"])
+def test_invalid_utf8_is_a_row_error(fmt):
+    stream = io.TextIOWrapper(io.BytesIO(b"\xff\xfe[{}]"), encoding="utf-8", newline="")
+    assert list(read_import(stream, fmt)) == [(1, None, "Invalid UTF-8")]
+
+
+def test_invalid_utf8_after_valid_rows():
+    body = (json.dumps({"first_name": "Ada"}) + "\n").encode() * 3 + b"{\"first_name\": \"\xff\"}\n"
+    stream = io.TextIOWrapper(io.BytesIO(body), encoding="utf-8", newline="")
+    rows = list(read_import(stream, "ndjson"))
+    assert rows[-1][1:] == (None, "Invalid UTF-8")
+    assert [data for row, data, error in rows[:-1]] == [{"first_name": "Ada"}] * len(rows[:-1])
+
+
+@pytest.mark.parametrize("data, error", [
+    ({"first_name": "Ada", "addresses": [{"city": "London"}]}, None),
+    ({"birth_date": "1815-12-10"}, None),
+    ([], "Contact must be an object"),
+    ({"addresses": {}}, "addresses must be a list"),
+    ({"addresses": ["London"]}, "addresses[0] must be an object"),
+    ({"first_name": 7}, "first_name must be a string"),
+    ({"birth_date": "10/12/1815"}, "birth_date must be an ISO date"),
+    ({"addresses": [{}, {"city": 1}]}, "addresses[1].city must be a string"),
+])
+def test_validate_import(data, error):
+    assert ContactDAO().validate_import(data) == error
+
+
+def test_validate_import_lengths():
+    dao = ContactDAO()
+    assert dao.validate_import({"first_name": "x" * 50, "addresses": [{"country": "x" * 6}]}) is None
+    assert dao.validate_import({"first_name": "x" * 51}) == "first_name is longer than 50 characters"
+    assert dao.validate_import({"addresses": [{"country": "x" * 7}]}) == "addresses[0].country is longer than 6 characters"
@@ -0,0 +1,28 @@
+from main import ContactDAO
+
+
+class ChangedDAO(ContactDAO):
+    """Settings changed after the migrations were released"""
+
+    SORT_FIELDS = ("contact_id", "first_name", "birth_date")
+    ADDRESS_SEARCH = {"phone": ("phone", str)}
+    CONTACT_COLUMNS = dict(ContactDAO.CONTACT_COLUMNS, nickname=20)
+
+
+def test_released_migrations_do_not_follow_the_settings():
+    assert ChangedDAO().migrations() == ContactDAO().migrations()
+
+
+def test_versions_are_increasing():
+    versions = [version for version, description, statements in ContactDAO().migrations()]
+    assert versions == sorted(set(versions))
+
+
+def test_table_names_are_substituted():
+    class Renamed(ContactDAO):
+        contact_table_name = "person"
+        address_table_name = "location"
+
+    for version, description, statements in Renamed().migrations():
+        for statement in statements:
+            assert " contact " not in statement and " address " not in statement
@@ -0,0 +1,44 @@
+import threading
+import time
+
+import main
+from main import ContactDAO
+
+
+class FakePool(object):
+    created = 0
+
+    def __init__(self, *args, **kwargs):
+        FakePool.created += 1
+        self.closed = False
+        # opening a real pool takes a while, long enough for the other first requests to arrive
+        time.sleep(0.05)
+
+    @staticmethod
+    def check_connection(conn):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+def test_concurrent_first_requests_open_one_pool(monkeypatch):
+    monkeypatch.setattr(main, "ConnectionPool", FakePool)
+    monkeypatch.setattr(ContactDAO, "pool", None)
+    FakePool.created = 0
+    start = threading.Barrier(8)
+    pools = []
+
+    def first_request():
+        start.wait()
+        pools.append(ContactDAO.get_pool())
+
+    threads = [threading.Thread(target=first_request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert FakePool.created == 1
+    assert all(pool is pools[0] for pool in pools)
+    ContactDAO.close_pool()
+    assert pools[0].closed and ContactDAO.pool is None
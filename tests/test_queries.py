@@ -0,0 +1,12 @@
+from main import ContactDAO
+
+
+def test_listing_rows_order_addresses_like_the_documents():
+    dao = ContactDAO()
+    for field in ("first_name", "contact_id"):
+        sql, params, field = dao.list_query(field, "asc", 10)
+        assert sql.endswith(", address.address_id")
+
+
+def test_contact_rows_order_addresses_like_the_documents():
+    assert ContactDAO().select_contacts_sql("contact.contact_id = %s").endswith(" ORDER BY address.address_id")
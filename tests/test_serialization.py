@@ -0,0 +1,60 @@
+import json
+from datetime import date
+
+import pytest
+from flask_restx import marshal
+
+from main import ContactDAO, contact, contact_json
+
+
+def make_rows(contacts, addresses):
+    """Tuple rows shaped like the listing query, as benchmarks/serialization.py builds them"""
+    rows = []
+    address_id = 0
+    for contact_id in range(1, contacts + 1):
+        head = (date(1980, 1, 1), "First %d" % contact_id, "Last %d" % contact_id, None, contact_id)
+        if addresses == 0:
+            rows.append(head + (None,) * 11)
+        for _ in range(addresses):
+            address_id += 1
+            rows.append(head + (contact_id, address_id, "CAN", "Mr", "K1A 0B1", "555-0100", "ON", "Ottawa",
+                                "%d Main Street" % address_id, None, "contact%d@example.com" % contact_id))
+    return rows
+
+
+EDGE_ROWS = [
+    # no addresses, every optional field empty
+    (None, None, None, None, 1) + (None,) * 11,
+    # non ASCII, quotes, backslashes and control characters
+    (date(1815, 12, 10), "Zoë", "O\"Brien\\", "é中\U0001f600", 2,
+     2, 7, "FRA", None, "75\t001", "+33\n1", "Île", "Paris ", "1 rue de l'Église", "\x00\x1f\x7f", "zoë@例え.jp"),
+    (date(1815, 12, 10), "Zoë", "O\"Brien\\", "é中\U0001f600", 2,
+     2, 9, None, "Dr", None, None, None, None, None, None, None),
+    # no addresses between contacts that have some
+    (None, "", "", "", 3) + (None,) * 11,
+    (None, "Ada", None, None, 4, 4, 10, "GBR", "Ms", "W1", "555", "LDN", "London", "12 St James's", None, ""),
+]
+
+
+def marshalled(rows):
+    dict_rows = [dict(zip(ContactDAO.ROW_COLUMNS, row)) for row in rows]
+    return json.dumps(marshal(list(ContactDAO().iter_contacts(dict_rows)), contact))
+
+
+def compiled(rows):
+    return contact_json.dumps_list(list(ContactDAO.iter_records(rows)))
+
+
+@pytest.mark.parametrize("contacts, addresses", [(0, 0), (1, 0), (5, 0), (1, 1), (20, 3)])
+def test_compiled_listing_matches_marshal(contacts, addresses):
+    rows = make_rows(contacts, addresses)
+    assert compiled(rows) == marshalled(rows)
+
+
+def test_compiled_listing_matches_marshal_on_edge_values():
+    assert compiled(EDGE_ROWS) == marshalled(EDGE_ROWS)
+
+
+def test_compiled_contact_matches_marshal():
+    for record, expected in zip(ContactDAO.iter_records(EDGE_ROWS), json.loads(marshalled(EDGE_ROWS))):
+        assert contact_json.dumps(record) == json.dumps(expected)